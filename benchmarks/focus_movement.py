@@ -0,0 +1,47 @@
+#!/usr/bin/python2
+# Times single-step focus moves in MappedList at increasing list lengths.
+# The per-move cost should stay flat as the list grows.
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import urwid
+from urwidgets import MappedList
+
+SIZES = (1000, 10000, 100000)
+MOVES = 2000
+
+
+def build(rows):
+    listbox = MappedList(urwid.SimpleFocusListWalker(
+        [urwid.Text(str(row)) for row in xrange(rows)]
+    ))
+    listbox.render((40, 20), focus=True)
+    return listbox
+
+
+def move(listbox):
+    for _ in xrange(MOVES):
+        listbox.shiftDown()
+    for _ in xrange(MOVES):
+        listbox.shiftUp()
+
+
+def main():
+    results = []
+    for rows in SIZES:
+        listbox = build(rows)
+        best = min(timeit.repeat(lambda: move(listbox), number=1, repeat=3))
+        per_move = best / (2 * MOVES) * 1e6
+        results.append(per_move)
+        print '%8d rows: %8.2f us/move' % (rows, per_move)
+
+    ratio = results[-1] / results[0]
+    print 'ratio %d/%d rows: %.2f' % (SIZES[-1], SIZES[0], ratio)
+    return 0 if ratio < 3 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
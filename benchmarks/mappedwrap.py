@@ -0,0 +1,44 @@
+#!/usr/bin/python2
+# Times MappedWrap construction and the per-keypress and per-render cost
+# of a wrapped row.
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import urwid
+from urwidgets import MappedWrap
+
+ROWS = 100000
+KEYPRESSES = 100000
+
+
+def construct(wrap, widgets):
+    return [wrap(widget, 'normal', {None: 'focus'}) for widget in widgets]
+
+
+def main():
+    widgets = [urwid.Text(str(row)) for row in xrange(ROWS)]
+    for name, wrap in (('AttrMap', urwid.AttrMap), ('MappedWrap', MappedWrap)):
+        best = min(timeit.repeat(
+            lambda: construct(wrap, widgets), number=1, repeat=3
+        ))
+        print 'construct %-10s %8.2f us/row' % (name + ':', best / ROWS * 1e6)
+
+    row = MappedWrap(urwid.Edit(), keymap={'f1': lambda: None})
+    keypress = lambda: [row.keypress((20,), 'f1') for _ in xrange(KEYPRESSES)]
+    best = min(timeit.repeat(keypress, number=1, repeat=3))
+    print 'keypress:            %8.2f us/key' % (best / KEYPRESSES * 1e6)
+
+    row = MappedWrap(urwid.Text('row'), 'normal', {None: 'focus'})
+    def render():
+        for focus in xrange(KEYPRESSES):
+            row._invalidate()
+            row.render((20,), focus=bool(focus % 2))
+    best = min(timeit.repeat(render, number=1, repeat=3))
+    print 'render:              %8.2f us/render' % (best / KEYPRESSES * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/python2
+# Drives the widgets headlessly, rendering canvases at a fixed size with no
+# terminal or main loop, and reports per-operation latency and the number
+# of gc-tracked objects each operation leaves alive.
+#
+#   suite.py                         run everything at 1k/100k/1M rows
+#   suite.py -r 1000 -k list.        only the MappedList cases at 1k rows
+#   suite.py --save base.json        keep the results
+#   suite.py --compare base.json     exit non-zero if any case got slower
+#                                    than --tolerance times the saved run
+#
+# Piles build and lay out a widget per row on every keypress, so they are
+# capped at PILE_ROWS. MappedList runs on a walker of built widgets up to
+# WALKER_ROWS and in virtual mode at every size.
+import argparse
+import gc
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import urwid
+from urwidgets import (MappedList, MappedPile, TitledPile, CommandFrame,
+                       CommandFrameController, utility)
+
+SIZES = (1000, 100000, 1000000)
+SIZE = (80, 24)
+PILE_ROWS = 10000
+WALKER_ROWS = 100000
+
+CASES = []
+
+
+def case(name, ops, max_rows=None):
+    # The decorated function builds the fixture for a row count and
+    # returns a callable that performs ops operations
+    def register(setup):
+        CASES.append((name, ops, max_rows, setup))
+        return setup
+    return register
+
+
+def rows(count):
+    return ['row %07d' % row for row in xrange(count)]
+
+
+def walker_list(count):
+    listbox = MappedList(urwid.SimpleFocusListWalker(
+        [urwid.SelectableIcon(row) for row in rows(count)]
+    ))
+    listbox.render(SIZE, focus=True)
+    return listbox
+
+
+def virtual_list(count):
+    listbox = MappedList(rows(count), factory=urwid.SelectableIcon)
+    listbox.render(SIZE, focus=True)
+    return listbox
+
+
+def pile(cls, count):
+    widgets = [urwid.SelectableIcon(row) for row in rows(count)]
+    if cls is TitledPile:
+        widget = TitledPile(urwid.Text('title'), widgets)
+    else:
+        widget = MappedPile(widgets)
+    widget.render(SIZE[:1], focus=True)
+    return widget
+
+
+def keypresses(widget, size, keys, ops):
+    # Down to the end and back, so the focus never sticks at an edge
+    def run():
+        for press in xrange(ops):
+            widget.keypress(size, keys[(press // 100) % 2])
+    return run
+
+
+def renders(widget, size, ops):
+    def run():
+        for _ in xrange(ops):
+            widget._invalidate()
+            widget.render(size, focus=True)
+    return run
+
+
+for mode, build, limit in (('walker', walker_list, WALKER_ROWS),
+                           ('virtual', virtual_list, None)):
+    @case('list.%s.keypress' % mode, 1000, limit)
+    def list_keypress(count, build=build):
+        return keypresses(build(count), SIZE, ('down', 'up'), 1000)
+
+    @case('list.%s.page' % mode, 200, limit)
+    def list_page(count, build=build):
+        return keypresses(build(count), SIZE, ('page down', 'page up'), 200)
+
+    @case('list.%s.render' % mode, 200, limit)
+    def list_render(count, build=build):
+        return renders(build(count), SIZE, 200)
+
+    @case('list.%s.jump' % mode, 1000, limit)
+    def list_jump(count, build=build):
+        listbox = build(count)
+        def run():
+            for step in xrange(1000):
+                listbox.jump(step % 100)
+                listbox.render(SIZE, focus=True)
+        return run
+
+
+@case('list.search', 5)
+def list_search(count):
+    # No index: a scan from the top to a row near the end
+    listbox = virtual_list(count)
+    target = 'row %07d' % (count - 10)
+    def run():
+        for _ in xrange(5):
+            listbox.search(lambda row: row == target, 'forward', start=0)
+    return run
+
+
+@case('list.rowstore.search', 5)
+def list_rowstore_search(count):
+    # The same scan over the raw buffer of a RowStore
+    listbox = MappedList(utility.RowStore.from_rows(rows(count)),
+                         factory=urwid.SelectableIcon)
+    listbox.render(SIZE, focus=True)
+    target = 'row %07d' % (count - 10)
+    def run():
+        for _ in xrange(5):
+            listbox.search(target, 'forward', start=0)
+    return run
+
+
+@case('list.indexed.search', 100)
+def list_indexed_search(count):
+    listbox = virtual_list(count)
+    listbox.set_search_index(lambda row: row)
+    target = 'row %07d' % (count - 10)
+    def run():
+        for _ in xrange(100):
+            listbox.search(lambda row: row == target, 'forward', start=0)
+    return run
+
+
+@case('list.indexed.next', 1000)
+def list_next(count):
+    # Every tenth row matches
+    listbox = virtual_list(count)
+    listbox.set_search_index(lambda row: row)
+    listbox.search(lambda row: row.endswith('0'), 'forward')
+    def run():
+        for step in xrange(1000):
+            if (step // 100) % 2:
+                listbox.prev()
+            else:
+                listbox.next()
+    return run
+
+
+@case('list.extend', 100)
+def list_extend(count):
+    # A full ring buffer taking a frame's batch of 1000 rows
+    listbox = MappedList(utility.RingBuffer(rows(count), max_rows=count),
+                         factory=urwid.SelectableIcon, follow=True)
+    listbox.bottom()
+    batch = rows(1000)
+    def run():
+        for _ in xrange(100):
+            listbox.extend(batch)
+            listbox.render(SIZE, focus=True)
+    return run
+
+
+@case('list.sorted.add', 1000)
+def list_sorted_add(count):
+    # Rows landing all over a sorted list
+    listbox = MappedList(rows(count)[::-1], factory=urwid.SelectableIcon,
+                         sort_key=lambda row: row)
+    listbox.render(SIZE, focus=True)
+    batch = ['row %07d+' % ((step * 7919) % count) for step in xrange(1000)]
+    def run():
+        for row in batch:
+            listbox.add(row)
+    return run
+
+
+for cls in (MappedPile, TitledPile):
+    name = cls.__name__.lower()
+
+    @case('%s.keypress' % name, 100, PILE_ROWS)
+    def pile_keypress(count, cls=cls):
+        return keypresses(pile(cls, count), SIZE[:1], ('down', 'up'), 100)
+
+    @case('%s.render' % name, 10, PILE_ROWS)
+    def pile_render(count, cls=cls):
+        return renders(pile(cls, count), SIZE[:1], 10)
+
+
+@case('complete.scan', 5)
+def complete_scan(count):
+    entries = rows(count)
+    def run():
+        for _ in xrange(5):
+            utility.complete(entries, 'row 00001')
+    return run
+
+
+@case('complete.index', 1000)
+def complete_index(count):
+    index = utility.CompletionIndex(rows(count))
+    def run():
+        for _ in xrange(1000):
+            index.complete('row 00001')
+    return run
+
+
+@case('complete.fuzzy', 10)
+def complete_fuzzy(count):
+    index = utility.FuzzyIndex(rows(count), limit=20)
+    def run():
+        for query in ('r01', 'w1', 'r0000', 'o9', 'row 1', 'x', 'r5', 'w7',
+                      'r 2', '99'):
+            index.complete(query)
+    return run
+
+
+@case('list.fuzzy_search', 10)
+def list_fuzzy_search(count):
+    listbox = virtual_list(count)
+    listbox.fuzzy_search('r', limit=20)
+    def run():
+        for query in ('r01', 'w1', 'r0000', 'o9', 'row 1', 'x', 'r5', 'w7',
+                      'r 2', '99'):
+            listbox.fuzzy_search(query, limit=20)
+    return run
+
+
+@case('complete.controller', 1000)
+def complete_controller(count):
+    # The index is built on the first call and reused after that
+    controller = CommandFrameController(None, {})
+    entries = rows(count)
+    controller.complete(entries, 'row')
+    def run():
+        for _ in xrange(1000):
+            controller.complete(entries, 'row 00001')
+    return run
+
+
+@case('commandframe.dispatch', 1000)
+def command_dispatch(count):
+    # Open the command line, type a command and submit it
+    listbox = virtual_list(count)
+    frame = CommandFrame(listbox, commands={
+        'goto': lambda row: listbox.set_focus(int(row) % count)
+    })
+    frame.render(SIZE, focus=True)
+    keys = [':'] + list('goto 42') + ['enter']
+    def run():
+        for _ in xrange(1000):
+            for key in keys:
+                frame.keypress(SIZE, key)
+    return run
+
+
+def measure(run, ops, repeat):
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+
+    gc.collect()
+    before = len(gc.get_objects())
+    run()
+    gc.collect()
+    retained = len(gc.get_objects()) - before
+
+    return best / ops * 1e6, float(retained) / ops
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rows', type=int, action='append')
+    parser.add_argument('-k', '--keyword', default='')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    options = parser.parse_args()
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as saved:
+            baseline = json.load(saved)
+
+    results = {}
+    slower = []
+    for count in options.rows or SIZES:
+        for name, ops, max_rows, setup in CASES:
+            if options.keyword not in name:
+                continue
+            if max_rows is not None and count > max_rows:
+                continue
+            latency, retained = measure(setup(count), ops, options.repeat)
+            key = '%s@%d' % (name, count)
+            results[key] = {'us': latency, 'objects': retained}
+
+            line = '%-28s %8d rows: %10.2f us/op %8.2f objs/op' % (
+                name, count, latency, retained
+            )
+            if key in baseline:
+                ratio = latency / baseline[key]['us']
+                line += '  x%.2f' % ratio
+                if ratio > options.tolerance:
+                    slower.append(key)
+            print line
+            sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, 'w') as saved:
+            json.dump(results, saved, indent=2, sort_keys=True)
+
+    if slower:
+        print 'slower than x%.2f: %s' % (options.tolerance, ', '.join(slower))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import StringIO
+import urwid
+from mock import Mock
+from urwidgets import instrument, CommandFrame, MappedList, MappedPile, MappedWrap
+
+
+class TestHistogram:
+    def test_record(self):
+        histogram = instrument.Histogram()
+        for micros in (1, 3, 3, 100):
+            histogram.record(micros / 1e6)
+        stats = histogram.export()
+        assert stats['count'] == 4
+        assert round(stats['max']) == 100
+        assert round(stats['min']) == 1
+        assert stats['p50'] == 4
+        assert stats['p99'] == 100
+        assert sum(stats['buckets']) == 4
+
+    def test_empty(self):
+        assert instrument.Histogram().percentile(50) == 0.0
+
+
+class TestInstrument:
+    def setup_method(self, method):
+        self.recorder = instrument.enable(instrument.Recorder())
+
+    def teardown_method(self, method):
+        instrument.disable()
+
+    def test_list(self):
+        action = Mock(return_value=None)
+        listbox = MappedList(urwid.SimpleFocusListWalker(
+            [urwid.SelectableIcon(str(i)) for i in range(10)]
+        ), keymap={'x': action})
+        listbox.render((10, 5), focus=True)
+        listbox.keypress((10, 5), 'down')
+        listbox.keypress((10, 5), 'x')
+        listbox.search(lambda w: w.text == '5', 'forward')
+        histograms = self.recorder.histograms
+        assert histograms['MappedList.keypress'].count == 2
+        assert histograms['MappedList.keymap'].count == 2
+        assert histograms['MappedList.render'].count == 1
+        assert histograms['MappedList.search'].count == 1
+
+    def test_instrument_name(self):
+        pile = MappedPile([urwid.SelectableIcon('a')])
+        pile.instrument_name = 'sidebar'
+        pile.keypress((10,), 'x')
+        assert 'sidebar.keypress' in self.recorder.histograms
+
+    def test_wrap_render(self):
+        wrap = MappedWrap(urwid.Text('a'))
+        wrap.render((10,))
+        assert self.recorder.histograms['MappedWrap.render'].count == 1
+
+    def test_disable(self):
+        keypress = MappedList.__dict__['keypress']
+        instrument.disable()
+        assert not instrument.enabled()
+        assert MappedList.__dict__['keypress'] is not keypress
+        assert 'render' not in CommandFrame.__dict__
+        MappedList(urwid.SimpleFocusListWalker([])).keypress((10, 5), 'x')
+        assert not self.recorder.histograms
+
+    def test_dump(self):
+        MappedPile([urwid.SelectableIcon('a')]).keypress((10,), 'x')
+        stream = StringIO.StringIO()
+        self.recorder.dump(stream)
+        assert 'MappedPile.keypress' in stream.getvalue()
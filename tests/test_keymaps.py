@@ -0,0 +1,158 @@
+import pytest
+import urwid
+from mock import Mock
+from urwidgets import Keymap, counted, MappedList, MappedWrap
+
+
+class Target(object):
+    pass
+
+
+class TestKeymap:
+    def setup_method(self, method):
+        self.widget = Target()
+        self.top = Mock(return_value=None)
+        self.down = Mock(return_value=None)
+        self.keymap = Keymap({('g', 'g'): self.top, 'j': self.down})
+
+    def test_single_key(self):
+        assert self.keymap.dispatch(self.widget, 'j') == (True, None)
+        assert self.down.call_count == 1
+
+    def test_unbound_key(self):
+        assert self.keymap.dispatch(self.widget, 'x') == (False, 'x')
+
+    def test_sequence(self):
+        assert self.keymap.dispatch(self.widget, 'g') == (True, None)
+        assert not self.top.called
+        self.keymap.dispatch(self.widget, 'g')
+        assert self.top.call_count == 1
+
+    def test_broken_sequence_passes_key_on(self):
+        self.keymap.dispatch(self.widget, 'g')
+        assert self.keymap.dispatch(self.widget, 'x') == (False, 'x')
+        self.keymap.dispatch(self.widget, 'j')
+        assert not self.top.called
+        assert self.down.call_count == 1
+
+    def test_timeout(self):
+        keymap = Keymap({('g', 'g'): self.top}, timeout=0)
+        keymap.dispatch(self.widget, 'g')
+        keymap.dispatch(self.widget, 'g')
+        assert not self.top.called
+
+    def test_ambiguous_prefix_resolves(self):
+        short = Mock(return_value=None)
+        keymap = Keymap({'g': short, ('g', 'g'): self.top})
+        keymap.dispatch(self.widget, 'g')
+        assert not short.called
+        keymap.resolve(self.widget)
+        assert short.call_count == 1
+
+    def test_ambiguous_prefix_alarm(self):
+        loop = Mock()
+        short = Mock(return_value=None)
+        keymap = Keymap({'g': short, ('g', 'g'): self.top}, loop=loop)
+        keymap.dispatch(self.widget, 'g')
+        callback = loop.set_alarm_in.call_args[0][1]
+        callback(loop, None)
+        assert short.call_count == 1
+
+    def test_ambiguous_prefix_alarm_removed(self):
+        loop = Mock()
+        loop.set_alarm_in.side_effect = ['first', 'second']
+        short = Mock(return_value=None)
+        keymap = Keymap({'g': short, ('g', 'g'): self.top, 'x': self.down},
+                        loop=loop)
+        keymap.dispatch(self.widget, 'g')
+        keymap.dispatch(self.widget, 'x')
+        loop.remove_alarm.assert_called_once_with('first')
+
+        keymap.dispatch(self.widget, 'g')
+        keymap.dispatch(self.widget, 'g')
+        assert short.call_count == 1
+        assert self.top.call_count == 1
+        loop.remove_alarm.assert_called_with('second')
+
+    def test_counts_repeat(self):
+        keymap = self.keymap.extend({}, counts=True)
+        keymap.dispatch(self.widget, '1')
+        keymap.dispatch(self.widget, '2')
+        keymap.dispatch(self.widget, 'j')
+        assert self.down.call_count == 12
+
+    def test_counted_action(self):
+        action = Mock(return_value=None)
+        keymap = Keymap({'j': counted(action)}, counts=True)
+        keymap.dispatch(self.widget, '5')
+        keymap.dispatch(self.widget, 'j')
+        keymap.dispatch(self.widget, 'j')
+        assert [c[0][0] for c in action.call_args_list] == [5, 1]
+
+    def test_counts_off(self):
+        assert self.keymap.dispatch(self.widget, '3') == (False, '3')
+
+    def test_extend(self):
+        other = Mock(return_value=None)
+        child = self.keymap.extend({'j': None, 'k': other})
+        assert 'j' not in child
+        assert 'k' in child
+        assert 'k' not in self.keymap
+        child.dispatch(self.widget, 'k')
+        assert other.called
+        assert self.keymap['j'] is self.down
+
+    def test_extend_keeps_settings(self):
+        keymap = Keymap({}, timeout=5.0, counts=True)
+        child = keymap.extend({})
+        assert child.timeout == 5.0
+        assert child.counts
+        assert keymap.extend({}, timeout=2.0).timeout == 2.0
+        assert Keymap().timeout == 1.0
+
+    def test_extend_sequence_copies(self):
+        other = Mock(return_value=None)
+        child = self.keymap.extend({('g', 'x'): other})
+        assert child[('g', 'g')] is self.top
+        with pytest.raises(KeyError):
+            self.keymap[('g', 'x')]
+
+    def test_shared_state_is_per_widget(self):
+        other = Target()
+        self.keymap.dispatch(self.widget, 'g')
+        self.keymap.dispatch(other, 'j')
+        self.keymap.dispatch(self.widget, 'g')
+        assert self.top.call_count == 1
+        assert self.down.call_count == 1
+
+
+class TestKeymapWidgets:
+    def test_mapped_list(self):
+        action = Mock(return_value=None)
+        keymap = Keymap({('g', 'g'): action})
+        lists = [MappedList(urwid.SimpleFocusListWalker(
+                    [urwid.SelectableIcon(str(i)) for i in range(5)]),
+                 keymap=keymap) for _ in range(3)]
+        assert all(l.keymap is keymap for l in lists)
+        lists[0].keypress((10, 3), 'g')
+        assert lists[0].keypress((10, 3), 'g') is None
+        assert action.call_count == 1
+        lists[1].keypress((10, 3), 'down')
+        assert lists[1].focus_position == 1
+
+    def test_mapped_wrap(self):
+        action = Mock(return_value=None)
+        wrap = MappedWrap(urwid.Button('a'),
+                          keymap=Keymap({('d', 'd'): action}))
+        wrap.keypress((10,), 'd')
+        wrap.keypress((10,), 'd')
+        assert action.call_count == 1
+
+    def test_key_used_by_widget(self):
+        action = Mock(return_value=None)
+        wrap = MappedWrap(urwid.Edit(),
+                          keymap=Keymap({'x': action}, counts=True))
+        assert wrap.keypress((10,), 'a') is None
+        assert wrap.keypress((10,), '3') is None
+        assert wrap.edit_text == 'a3'
+        assert not action.called
@@ -0,0 +1,206 @@
+import os
+import time
+import threading
+import pytest
+from mock import Mock
+from urwidgets import runner
+from urwidgets.runner import CommandRunner, UpdateChannel, in_thread, in_process
+
+
+def double(value):
+    return int(value) * 2
+
+def explode():
+    raise ValueError('boom')
+
+
+class TestCommandRunner:
+    def setup_method(self):
+        self.read_fd, write_fd = os.pipe()
+        self.loop = Mock()
+        self.loop.watch_pipe.return_value = write_fd
+        self.report = Mock()
+        self.sut = CommandRunner(self.loop, self.report, max_workers=1)
+
+    def teardown_method(self):
+        self.sut.close()
+
+    def wait(self):
+        os.read(self.read_fd, 1)
+        self.sut._collect(None)
+
+    def step(self):
+        callback = self.loop.set_alarm_in.call_args[0][1]
+        callback(self.loop, None)
+
+    def test_run_mode(self):
+        def coroutine():
+            yield
+
+        assert runner.run_mode(in_thread(lambda: None)) == 'thread'
+        assert runner.run_mode(in_process(double)) == 'process'
+        assert runner.run_mode(coroutine) == 'coroutine'
+        assert runner.run_mode(lambda: None) is None
+
+    def test_thread_command(self):
+        self.sut.submit('double', in_thread(double), ['2'])
+
+        self.wait()
+
+        self.report.assert_called_once_with('double done')
+        assert not self.sut.running
+
+    def test_thread_command_error(self):
+        self.sut.submit('explode', in_thread(explode), [])
+
+        self.wait()
+
+        self.report.assert_called_once_with('explode failed: boom')
+
+    def test_process_command(self):
+        self.sut.submit('double', in_process(double), ['2'])
+
+        self.wait()
+
+        self.report.assert_called_once_with('double done')
+
+    def test_wrong_arguments_raise_before_queueing(self):
+        with pytest.raises(TypeError):
+            self.sut.submit('double', in_thread(double), [])
+
+        assert not self.sut.pending
+        assert not self.sut.running
+
+    def test_coroutine_command(self):
+        steps = []
+        def count(limit):
+            for value in xrange(int(limit)):
+                steps.append(value)
+                yield
+
+        self.sut.submit('count', count, ['2'])
+        self.step()
+        self.step()
+        assert steps == [0, 1]
+        self.step()
+
+        self.report.assert_called_once_with('count done')
+
+    def test_concurrency_limit_queues(self):
+        def wait():
+            yield
+
+        self.sut.submit('first', wait, [])
+        self.sut.submit('second', wait, [])
+
+        assert len(self.sut.running) == 1
+        assert len(self.sut.pending) == 1
+        self.report.assert_called_once_with('second queued')
+
+    def test_cancel(self):
+        def forever():
+            while True:
+                yield
+
+        self.sut.submit('first', forever, [])
+        self.sut.submit('second', forever, [])
+        self.sut.cancel()
+
+        assert not self.sut.running
+        assert not self.sut.pending
+        self.loop.remove_alarm.assert_called_once()
+        self.report.assert_called_with('Cancelled')
+
+
+class TestUpdateChannel:
+    def setup_method(self):
+        self.read_fd, write_fd = os.pipe()
+        self.loop = Mock()
+        self.loop.watch_pipe.return_value = write_fd
+        self.sut = UpdateChannel(self.loop)
+        self.widget = Mock()
+
+    def wake(self):
+        self.sut._wake(os.read(self.read_fd, 1024))
+
+    def test_last_set_wins(self):
+        self.sut.push(self.widget, 'set', [1])
+        self.sut.push(self.widget, 'set', [2])
+        self.sut.flush()
+
+        self.widget.set.assert_called_once_with([2])
+
+    def test_extends_merged(self):
+        self.sut.push(self.widget, 'extend', [1])
+        self.sut.push(self.widget, 'extend', (2, 3))
+        self.sut.flush()
+
+        self.widget.extend.assert_called_once_with([1, 2, 3])
+
+    def test_set_drops_earlier_appends(self):
+        self.sut.push(self.widget, 'extend', [1])
+        self.sut.push(self.widget, 'add', 'a')
+        self.sut.push(self.widget, 'set', [0])
+        self.sut.push(self.widget, 'extend', [2])
+        self.sut.flush()
+
+        assert not self.widget.add.called
+        assert self.widget.method_calls == [
+            (('set', ([0],), {})), (('extend', ([2],), {}))
+        ]
+
+    def test_adds_repeated(self):
+        self.sut.push(self.widget, 'add', 'a')
+        self.sut.push(self.widget, 'add', 'b')
+        self.sut.flush()
+
+        assert [c[0][0] for c in self.widget.add.call_args_list] == ['a', 'b']
+
+    def test_other_calls_kept_in_order(self):
+        self.sut.push(self.widget, 'shiftDown')
+        self.sut.push(self.widget, 'shiftDown', 2)
+        self.sut.flush()
+
+        assert self.widget.shiftDown.call_count == 2
+
+    def test_per_widget(self):
+        other = Mock()
+        self.sut.push(self.widget, 'change_status', 'a')
+        self.sut.push(other, 'change_status', 'b')
+        self.sut.flush()
+
+        self.widget.change_status.assert_called_once_with('a')
+        other.change_status.assert_called_once_with('b')
+
+    def test_one_wakeup_per_flush(self):
+        for n in range(100):
+            self.sut.push(self.widget, 'set', [n])
+        assert len(os.read(self.read_fd, 1024)) == 1
+
+        self.sut._wake('x')
+        self.sut._wake('x')
+        assert self.loop.set_alarm_in.call_count == 1
+        self.loop.set_alarm_in.call_args[0][1](self.loop, None)
+        self.widget.set.assert_called_once_with([99])
+
+    def test_rate_bounded(self):
+        self.sut.flush()
+        self.sut.push(self.widget, 'set', [1])
+        self.wake()
+
+        delay = self.loop.set_alarm_in.call_args[0][0]
+        assert 0.02 < delay <= 1 / 30.0
+
+    def test_threads(self):
+        def work(base):
+            for n in range(100):
+                self.sut.push(self.widget, 'extend', [base + n])
+
+        workers = [threading.Thread(target=work, args=(base,)) for base in (0, 1000)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.sut.flush()
+
+        assert sorted(self.widget.extend.call_args[0][0]) == range(100) + range(1000, 1100)
@@ -1,6 +1,14 @@
+import gc
+import os
+import re
+import time
+import Queue
 import pytest
+import urwid
 from mock import Mock, create_autospec
-from urwidgets import CommandFrameController
+from urwidgets import CommandFrameController, CommandFrame, MappedList, IncrementalSearch
+from urwidgets import MappedPile, MappedWrap, RowStream, TitledPile
+from urwidgets import utility
 
 class TestCommandFrameController:
     def setup_method(self):
@@ -88,7 +96,7 @@ class TestCommandFrameController:
     def test_start_editing_complete(self):
         self.widget.command_line_text = 'yes'
         
-        complete, enter, backspace = self.sut.start_editing(None, ('yesterday',))
+        tab, complete, enter, backspace = self.sut.start_editing(None, ('yesterday',))
         complete()
 
         assert self.widget.command_line_text == 'yesterday'
@@ -98,7 +106,7 @@ class TestCommandFrameController:
         self.sut.submit_command = Mock()
         self.widget.command_line_text = 'command'
         
-        complete, enter, backspace = self.sut.start_editing(None, [])
+        tab, complete, enter, backspace = self.sut.start_editing(None, [])
         enter()
 
         self.widget.stop_editing.assert_called_once()
@@ -109,7 +117,7 @@ class TestCommandFrameController:
         self.widget.command_line_text = 'new command'
         callback = Mock()
 
-        complete, enter, backspace = self.sut.start_editing(callback, ())
+        tab, complete, enter, backspace = self.sut.start_editing(callback, ())
         enter()
 
         self.widget.stop_editing.assert_called_once()
@@ -121,7 +129,7 @@ class TestCommandFrameController:
         self.widget.command_line_text = ''
         callback = Mock()
 
-        complete, enter, backspace = self.sut.start_editing(callback, ())
+        tab, complete, enter, backspace = self.sut.start_editing(callback, ())
         backspace()
 
         self.widget.stop_editing.assert_called_once()
@@ -133,10 +141,1676 @@ class TestCommandFrameController:
         self.widget.command_line_text = 'not empty command'
         callback = Mock()
 
-        complete, enter, backspace = self.sut.start_editing(callback, ())
+        tab, complete, enter, backspace = self.sut.start_editing(callback, ())
         backspace()
 
         self.widget.stop_editing.assert_not_called()
         self.sut.submit_command.assert_not_called()
         callback.assert_not_called()
 
+
+class TestMappedListVirtual:
+    def setup_method(self):
+        self.source = xrange(1000000)
+        self.factory = Mock(side_effect=lambda row: urwid.Text(str(row)))
+        self.sut = MappedList(self.source, factory=self.factory)
+
+    def test_render_builds_visible_rows_only(self):
+        self.sut.render((20, 10), focus=True)
+
+        assert self.factory.call_count < 50
+
+    def test_bottom(self):
+        self.sut.bottom()
+
+        assert self.sut.focus_position == 999999
+        assert self.sut.focus.text == '999999'
+
+    def test_top(self):
+        self.sut.set_focus(500)
+        self.sut.top()
+
+        assert self.sut.focus_position == 0
+
+    def test_shift(self):
+        self.sut.shiftDown(3)
+        self.sut.shiftUp()
+
+        assert self.sut.focus_position == 2
+
+    def test_search_runs_against_source(self):
+        index = self.sut.search(lambda row: row % 1000 == 999, 'forward')
+
+        assert index == 999
+        assert self.factory.call_count <= 1
+
+    def test_next_prev(self):
+        self.sut.search(lambda row: row % 1000 == 0, 'forward', start=1)
+
+        self.sut.next()
+        assert self.sut.focus_position == 1000
+        self.sut.next()
+        assert self.sut.focus_position == 2000
+        self.sut.prev()
+        assert self.sut.focus_position == 1000
+
+    def test_set(self):
+        self.sut.set_focus(10)
+        self.sut.set(xrange(5))
+
+        assert len(self.sut.body) == 5
+        assert self.sut.focus_position == 4
+
+
+class TestMappedListFocus:
+    def setup_method(self):
+        self.body = urwid.SimpleFocusListWalker(
+            [urwid.Text(str(row)) for row in xrange(1000)]
+        )
+        self.sut = MappedList(self.body)
+        self.modified = Mock()
+        urwid.connect_signal(self.body, 'modified', self.modified)
+
+    def test_shift_does_not_rewrite_body(self):
+        self.sut.shiftDown()
+        self.sut.shiftUp()
+        self.sut.set_focus(500)
+
+        self.modified.assert_not_called()
+
+    def test_shift_redraws(self):
+        before = self.sut.render((10, 5), focus=True)
+        self.sut.shiftDown()
+        after = self.sut.render((10, 5), focus=True)
+
+        assert before is not after
+        assert self.sut.focus_position == 1
+
+    def test_shift_past_end_emits_bottom(self):
+        bottom = Mock()
+        urwid.connect_signal(self.sut, 'bottom', bottom)
+        self.sut.set_focus(999)
+
+        self.sut.shiftDown()
+
+        bottom.assert_called_once()
+
+
+class TestMappedListSearchIndex:
+    def setup_method(self):
+        self.body = urwid.SimpleFocusListWalker(
+            [urwid.Text(str(row)) for row in xrange(100)]
+        )
+        self.key = Mock(side_effect=lambda widget: int(widget.text))
+        self.sut = MappedList(self.body, index_key=self.key)
+        self.predicate = lambda row: row % 10 == 0
+
+    def test_key_computed_once_per_row(self):
+        self.sut.search(self.predicate, 'forward', start=1)
+        self.sut.next()
+        self.sut.next()
+        self.sut.prev()
+
+        assert self.key.call_count == 100
+
+    def test_next_prev(self):
+        assert self.sut.search(self.predicate, 'forward', start=1) == 10
+
+        self.sut.set_focus(10)
+        self.sut.next()
+        assert self.sut.focus_position == 20
+        self.sut.prev()
+        assert self.sut.focus_position == 10
+        self.sut.prev()
+        assert self.sut.focus_position == 0
+        self.sut.prev()
+        assert self.sut.focus_position == 90
+
+    def test_append_remove(self):
+        self.sut.search(self.predicate, 'forward')
+        self.body.append(urwid.Text('1000'))
+        del self.body[0:5]
+
+        assert self.sut.search_index.keys[0] == 5
+        assert self.sut.search_index.matches(self.predicate)[-1] == 95
+        assert self.key.call_count == 101
+
+    def test_set(self):
+        self.sut.search(self.predicate, 'forward')
+        self.sut.set([urwid.Text('3'), urwid.Text('20')])
+
+        assert self.sut.search_index.keys == [3, 20]
+        assert self.sut.search_index.matches(self.predicate) == [1]
+
+    def test_explicit_key_bypasses_index(self):
+        index = self.sut.search(
+            lambda text: text == '42', 'forward', key=lambda w: w.text
+        )
+
+        assert index == 42
+
+
+class TestIncrementalSearch:
+    def setup_method(self):
+        self.rows = ['row %d' % row for row in xrange(1000)]
+        self.listbox = MappedList(self.rows, factory=urwid.Text)
+        self.listbox.set_focus(500)
+        self.match = Mock(side_effect=lambda query, row: row.endswith(query))
+
+    def test_update_synchronous(self):
+        sut = IncrementalSearch(self.listbox, match=self.match)
+
+        sut.update('7')
+
+        assert self.listbox.focus_position == 507
+        assert sut.done
+
+    def test_extended_query_narrows(self):
+        sut = IncrementalSearch(self.listbox, match=self.match)
+        sut.update('7')
+        self.match.reset_mock()
+
+        sut.update('77')
+
+        assert self.match.call_count == 100
+        assert self.listbox.focus_position == 577
+
+    def test_no_match_returns_to_anchor(self):
+        sut = IncrementalSearch(self.listbox, match=self.match)
+        sut.update('7')
+
+        sut.update('x')
+
+        assert self.listbox.focus_position == 500
+
+    def test_chunks_scheduled_on_loop(self):
+        loop = Mock()
+        sut = IncrementalSearch(self.listbox, loop, match=self.match, chunk_size=100)
+
+        sut.update('0')
+        assert self.match.call_count == 0
+        assert not sut.done
+
+        callback = loop.set_alarm_in.call_args[0][1]
+        callback(loop, None)
+        assert self.match.call_count == 100
+        assert self.listbox.focus_position == 500
+
+    def test_new_keystroke_cancels_scan(self):
+        loop = Mock()
+        sut = IncrementalSearch(self.listbox, loop, match=self.match, chunk_size=100)
+        sut.update('1')
+        handle = loop.set_alarm_in.return_value
+
+        sut.update('12')
+
+        loop.remove_alarm.assert_called_once_with(handle)
+
+
+class TestCommandFrameControllerCompletion:
+    def setup_method(self):
+        self.widget = Mock()
+        self.sut = CommandFrameController(self.widget, {})
+
+    def test_index_cached_per_completion_set(self):
+        completion_set = ('alpha', 'beta')
+
+        first = self.sut.completion_index(completion_set)
+        second = self.sut.completion_index(completion_set)
+
+        assert first is second
+
+    def test_mutable_set_not_cached(self):
+        completion_set = ['alpha']
+        self.sut.completion_index(completion_set)
+        completion_set.append('beta')
+
+        assert self.sut.completion_index(completion_set).hits('b') == ['beta']
+
+    def test_index_rebuilt_for_new_set(self):
+        first = self.sut.completion_index(('alpha',))
+        second = self.sut.completion_index(('beta',))
+
+        assert first is not second
+
+    def test_complete_cycles_hits(self):
+        self.widget.command_line_text = 'a'
+        tab, complete, enter, backspace = self.sut.start_editing(
+            None, ('alpha', 'abc')
+        )
+
+        complete()
+        assert self.widget.command_line_text == 'a'
+        complete()
+        assert self.widget.command_line_text == 'abc'
+        complete()
+        assert self.widget.command_line_text == 'alpha'
+
+    def test_complete_per_argument_position(self):
+        files = Mock(return_value=['notes.txt', 'notes.md'])
+        sources = {
+            0: ('open', 'close'),
+            2: files,
+        }
+        self.sut._sources[files] = utility.CompletionSource(files, background=False)
+
+        assert self.sut.complete(sources, 'op')[0] == 'open'
+        assert self.sut.complete(sources, 'open x no') == (
+            'open x notes.',
+            ('open x notes.md', 'open x notes.txt')
+        )
+        assert self.sut.complete(sources, 'open ') == ('open ', ())
+        files.assert_called_once_with('open', 'x')
+
+    def test_complete_quoted_arguments(self):
+        files = Mock(return_value=['notes.txt'])
+        self.sut._sources[files] = utility.CompletionSource(files, background=False)
+
+        assert self.sut.complete({2: files}, 'open "my dir" no')[0] == \
+            'open "my dir" notes.txt'
+        files.assert_called_once_with('open', 'my dir')
+        assert self.sut.complete({2: files}, 'open "my dir no') == \
+            ('open "my dir no', ())
+
+    def test_sources_bounded(self):
+        for _ in xrange(100):
+            self.sut.completion_source(lambda *args: [])
+        files = lambda *args: []
+        source = self.sut.completion_source(files)
+
+        assert len(self.sut._sources) <= 16
+        assert self.sut.completion_source(files) is source
+
+    def test_complete_fuzzy(self):
+        self.widget.command_line_text = 'of'
+        fuzzy = utility.FuzzyIndex(['open_file', 'close', 'reopen file'])
+        tab, complete, enter, backspace = self.sut.start_editing(None, fuzzy)
+
+        complete()
+        assert self.widget.command_line_text == 'of'
+        complete()
+        assert self.widget.command_line_text == 'open_file'
+        complete()
+        assert self.widget.command_line_text == 'reopen file'
+
+    def test_complete_fuzzy_argument(self):
+        files = utility.CompletionSource(
+            lambda command: ['notes.txt', 'todo.txt'], background=False,
+            index_type=utility.FuzzyIndex
+        )
+
+        assert self.sut.complete({1: files}, 'open tdt') == (
+            'open todo.txt', ('open todo.txt',)
+        )
+
+
+class TestMappedListMemory:
+    def test_set_focus_memory_flat(self):
+        body = urwid.SimpleFocusListWalker(
+            [urwid.Text(str(row)) for row in xrange(100)]
+        )
+        sut = MappedList(body)
+        for position in xrange(1000):
+            sut.set_focus(position % 100)
+
+        gc.collect()
+        before = len(gc.get_objects())
+        for position in xrange(1000000):
+            sut.set_focus(position % 100)
+        gc.collect()
+
+        assert len(gc.get_objects()) - before < 100
+
+
+class TestCommandFrameControllerRunner:
+    def setup_method(self):
+        self.widget = Mock()
+        self.runner = Mock()
+        self.runner.accepts = lambda func: getattr(func, 'background', False)
+        self.background = Mock(background=True)
+        self.inline = Mock(background=False)
+        self.sut = CommandFrameController(
+            self.widget,
+            {'background': self.background, 'inline': self.inline},
+            runner=self.runner
+        )
+
+    def test_background_command_submitted(self):
+        self.sut.submit_command('background a b')
+
+        self.runner.submit.assert_called_once_with(
+            'background', self.background, ['a', 'b']
+        )
+        self.background.assert_not_called()
+
+    def test_inline_command_called(self):
+        self.sut.submit_command('inline a')
+
+        self.inline.assert_called_once_with('a')
+        self.runner.submit.assert_not_called()
+
+    def test_background_wrong_arguments(self):
+        self.runner.submit.side_effect = TypeError
+
+        self.sut.submit_command('background a')
+
+        self.widget.change_status.assert_called_once_with("Wrong number of arguments")
+
+
+class TestCommandFrameControllerBatch:
+    def setup_method(self):
+        self.widget = Mock()
+        self.calls = []
+        self.commands = {
+            'one': lambda value: self.calls.append(('one', value)),
+            'none': lambda: self.calls.append(('none',)),
+        }
+        self.sut = CommandFrameController(self.widget, self.commands)
+
+    def test_run_batch(self):
+        script = '''
+            # comment
+            one first
+            none
+
+            one "second value"
+        '''
+
+        assert self.sut.run_batch(script)
+
+        assert self.calls == [
+            ('one', 'first'), ('none',), ('one', 'second value')
+        ]
+        self.widget.change_status.assert_not_called()
+
+    def test_run_batch_validates_up_front(self):
+        assert not self.sut.run_batch(['one a', 'none extra', 'one b'])
+
+        self.widget.change_status.assert_called_once_with(
+            "Line 2: Wrong number of arguments"
+        )
+        assert self.calls == []
+
+    def test_run_batch_unknown_command(self):
+        assert not self.sut.run_batch('one a\nmissing')
+
+        self.widget.change_status.assert_called_once_with(
+            "Line 2: Command not found"
+        )
+
+    def test_run_script(self, tmpdir):
+        path = tmpdir.join('script')
+        path.write('one a\none b\n')
+
+        self.sut.run_script(str(path))
+
+        assert self.calls == [('one', 'a'), ('one', 'b')]
+
+    def test_record_macro(self):
+        self.sut.start_recording()
+        self.sut.submit_command('one a')
+        self.sut.submit_command('missing')
+        self.sut.submit_command('none')
+        macro = self.sut.stop_recording('macro')
+        del self.calls[:]
+
+        self.sut.run_macro('macro')
+
+        assert len(macro) == 2
+        assert self.calls == [('one', 'a'), ('none',)]
+
+
+class TestCommandFrameSuspended:
+    def setup_method(self):
+        self.sut = CommandFrame(urwid.Filler(urwid.Text('')))
+
+    def test_status_held_until_resumed(self):
+        with self.sut.suspended():
+            self.sut.change_status('first')
+            self.sut.change_status('second')
+            assert self.sut.footer is self.sut.command_line
+
+        assert self.sut.footer.text == 'second'
+
+    def test_run_batch_shows_last_status(self):
+        sut = CommandFrame(urwid.Filler(urwid.Text('')), commands={
+            'say': lambda text: sut.change_status(text)
+        })
+
+        sut.run_batch(['say a', 'say b'])
+
+        assert sut.footer.text == 'b'
+
+
+class TestCommandFrameKeymap:
+    def test_subclass_esc_kept(self):
+        escape = Mock(return_value=None)
+
+        class EscapeFrame(CommandFrame):
+            def __init__(self, body):
+                self.keymap = {'esc': escape}
+                super(EscapeFrame, self).__init__(body)
+
+        sut = EscapeFrame(urwid.Filler(urwid.Text('')))
+
+        assert sut.keymap['esc'] is escape
+        assert ':' in sut.keymap
+
+    def test_esc_cancels_by_default(self):
+        sut = CommandFrame(urwid.Filler(urwid.Text('')))
+        assert sut.keymap['esc'] == sut.cancel_commands
+
+
+class TestMappedListMoves:
+    def setup_method(self):
+        self.sut = MappedList(xrange(1000), factory=lambda row: urwid.Text(str(row)))
+        self.shift = Mock()
+        urwid.connect_signal(self.sut, 'shift', self.shift)
+
+    def test_shift_amount_single_signal(self):
+        self.sut.shiftDown(250)
+
+        assert self.sut.focus_position == 250
+        self.shift.assert_called_once()
+
+    def test_page_keys(self):
+        self.sut.keypress((20, 10), 'page down')
+        assert self.sut.focus_position == 9
+
+        self.sut.keypress((20, 10), 'page up')
+        assert self.sut.focus_position == 0
+
+    def test_jump(self):
+        self.sut.jump(50)
+        assert self.sut.focus_position == 500
+
+        self.sut.jump(100)
+        assert self.sut.focus_position == 999
+
+    def test_coalesced_until_alarm(self):
+        self.sut.coalesce = True
+        self.sut.loop = Mock()
+        for _ in xrange(20):
+            self.sut.keypress((20, 10), 'down')
+
+        self.sut.render((20, 10), focus=True)
+        self.shift.assert_not_called()
+        self.sut.loop.set_alarm_in.assert_called_once()
+
+        delay, callback = self.sut.loop.set_alarm_in.call_args[0]
+        callback(self.sut.loop, None)
+        assert delay == 0
+        self.shift.assert_called_once()
+        assert self.sut.focus_position == 20
+
+    def test_coalesced_shift_drawn(self):
+        self.sut.coalesce = True
+        self.sut.loop = Mock()
+        header = urwid.Text('pos 0')
+        frame = urwid.Frame(self.sut, header=header)
+        urwid.connect_signal(self.sut, 'shift', lambda: header.set_text(
+            'pos %d' % self.sut.focus_position))
+        for _ in xrange(5):
+            frame.keypress((20, 10), 'down')
+
+        # As the loop does: alarms that are due, then the redraw
+        for call in self.sut.loop.set_alarm_in.call_args_list:
+            call[0][1](self.sut.loop, None)
+        canvas = frame.render((20, 10), focus=True)
+
+        assert canvas.text[0].rstrip() == 'pos 5'
+
+    def test_coalesced_without_loop_until_flush(self):
+        self.sut.coalesce = True
+        self.sut.keypress((20, 10), 'down')
+        self.sut.keypress((20, 10), 'down')
+
+        self.sut.render((20, 10), focus=True)
+        self.shift.assert_not_called()
+        self.sut.flush()
+        self.shift.assert_called_once()
+
+
+class TestMappedPileMoves:
+    def setup_method(self):
+        self.widgets = [urwid.Edit(str(index)) for index in xrange(10)]
+        self.sut = MappedPile(
+            self.widgets,
+            constraint=lambda index, widget: index % 2 == 0
+        )
+        self.sut.focus_position = 0
+        self.shift = Mock()
+        urwid.connect_signal(self.sut, 'shift', self.shift)
+
+    def test_shift_down_amount(self):
+        self.sut.shiftDown(2)
+
+        assert self.sut.focus_position == 4
+        self.shift.assert_called_once()
+
+    def test_shift_down_clamps(self):
+        self.sut.shiftDown(100)
+
+        assert self.sut.focus_position == 8
+
+    def test_shift_up_amount(self):
+        self.sut.focus_position = 8
+        self.sut.shiftUp(3)
+
+        assert self.sut.focus_position == 2
+
+    def test_shift_past_end_emits_bottom(self):
+        bottom = Mock()
+        urwid.connect_signal(self.sut, 'bottom', bottom)
+        self.sut.focus_position = 8
+
+        self.sut.shiftDown()
+
+        bottom.assert_called_once()
+        self.shift.assert_not_called()
+
+    def test_coalesced_until_alarm(self):
+        self.sut.coalesce = True
+        self.sut.loop = Mock()
+        self.sut.shiftDown()
+        self.sut.shiftDown()
+
+        self.sut.render((20,))
+        self.shift.assert_not_called()
+        self.sut.loop.set_alarm_in.assert_called_once()
+
+        self.sut.loop.set_alarm_in.call_args[0][1](self.sut.loop, None)
+        self.shift.assert_called_once()
+
+
+class TestMappedPileSelectableIndex:
+    def setup_method(self):
+        self.constraint = Mock(side_effect=lambda index, widget: widget.selectable())
+        self.sut = MappedPile(
+            [urwid.Edit(), urwid.Text(''), urwid.Edit()],
+            constraint=self.constraint
+        )
+
+    def test_constraint_evaluated_once(self):
+        self.sut.selectable_positions()
+        self.constraint.reset_mock()
+
+        self.sut.selectable()
+        self.sut.shiftDown()
+        self.sut.shiftUp()
+        self.sut.bottom()
+        self.sut.top()
+
+        self.constraint.assert_not_called()
+        assert self.sut.focus_position == 0
+
+    def test_add_extends_index(self):
+        self.sut.selectable_positions()
+        self.constraint.reset_mock()
+
+        self.sut.add(urwid.Edit())
+
+        assert self.constraint.call_count == 1
+        assert self.sut.selectable_positions() == [0, 2, 3]
+
+    def test_set_rebuilds_index(self):
+        self.sut.selectable_positions()
+
+        self.sut.set([urwid.Text(''), urwid.Edit()])
+
+        assert self.sut.selectable_positions() == [1]
+
+    def test_insert_rebuilds_index(self):
+        self.sut.selectable_positions()
+
+        self.sut.contents.insert(0, (urwid.Text(''), self.sut.options()))
+
+        assert self.sut.selectable_positions() == [1, 3]
+
+    def test_constraint_change_rebuilds_index(self):
+        self.sut.selectable_positions()
+
+        self.sut.constraint = lambda index, widget: True
+
+        assert self.sut.selectable_positions() == [0, 1, 2]
+
+    def test_not_selectable_when_empty(self):
+        assert not MappedPile([]).selectable()
+
+
+class TestMappedWrap:
+    def test_signals_of_all_wrapped_classes_supported(self):
+        MappedWrap(urwid.Edit())
+        MappedWrap(urwid.Button(''))
+
+        supported = urwid.signals._signals._supported[MappedWrap]
+        assert 'change' in supported
+        assert 'click' in supported
+
+    def test_signals_forwarded_to_widget(self):
+        edit = urwid.Edit()
+        sut = MappedWrap(edit)
+        callback = Mock()
+        urwid.connect_signal(sut, 'change', callback)
+
+        edit.set_edit_text('new')
+
+        callback.assert_called_once()
+
+    def test_attrmap_state_not_set_on_widget(self):
+        inner = urwid.AttrMap(urwid.Text(''), 'inner')
+        sut = MappedWrap(inner, 'outer')
+
+        assert inner.attr_map == {None: 'inner'}
+        assert sut.attr_map == {None: 'outer'}
+
+    def test_other_attributes_delegated(self):
+        text = urwid.Text('')
+        sut = MappedWrap(text)
+
+        sut.custom = 1
+
+        assert text.custom == 1
+        assert sut.custom == 1
+
+    def test_frozen_keymap_shared(self):
+        keymap = utility.FrozenKeymap({'a': lambda: None})
+
+        first = MappedWrap(urwid.Text(''), keymap=keymap)
+        second = MappedWrap(urwid.Text(''), keymap=keymap)
+
+        assert first.keymap is second.keymap
+
+    def test_default_keymap_is_private_once_used(self):
+        first = MappedWrap(urwid.Text(''))
+        second = MappedWrap(urwid.Text(''))
+        callback = Mock(return_value=None)
+
+        first.keymap['a'] = callback
+
+        assert first.keypress((10,), 'a') is None
+        assert second.keypress((10,), 'a') == 'a'
+        callback.assert_called_once()
+
+
+class TestMappedListFilter:
+    def setup_method(self):
+        self.rows = ['apple', 'apricot', 'banana', 'grape', 'pineapple']
+        self.sut = MappedList(self.rows, factory=urwid.SelectableIcon)
+        self.match = Mock(side_effect=lambda query, row: query in row)
+
+    def test_filter(self):
+        self.sut.filter('ap', self.match)
+
+        assert self.sut.filtered
+        assert len(self.sut.body) == 4
+        assert self.sut.focus.text == 'apple'
+        assert self.rows == ['apple', 'apricot', 'banana', 'grape', 'pineapple']
+
+    def test_extended_query_checks_previous_matches(self):
+        self.sut.filter('ap', self.match)
+        self.match.reset_mock()
+        self.sut.filter('app', self.match)
+
+        assert self.match.call_count == 4
+        assert [self.sut.original_position(p) for p in range(len(self.sut.body))] == [0, 4]
+
+    def test_shortened_query_reuses_results(self):
+        self.sut.filter('ap', self.match)
+        self.sut.filter('app', self.match)
+        self.match.reset_mock()
+        self.sut.filter('ap', self.match)
+
+        assert not self.match.called
+        assert len(self.sut.body) == 4
+
+    def test_focus_maps_to_original(self):
+        self.sut.set_focus(3)
+        self.sut.filter('ap', self.match)
+
+        assert self.sut.focus.text == 'grape'
+        self.sut.shiftDown()
+        assert self.sut.original_position() == 4
+
+        self.sut.unfilter()
+        assert not self.sut.filtered
+        assert self.sut.focus_position == 4
+
+    def test_empty_query_unfilters(self):
+        self.sut.filter('ap', self.match)
+        self.sut.filter('', self.match)
+
+        assert len(self.sut.body) == 5
+
+    def test_no_matches(self):
+        self.sut.filter('xyz', self.match)
+        self.sut.render((20, 5), focus=True)
+
+        assert len(self.sut.body) == 0
+        assert self.sut.original_position() is None
+        self.sut.unfilter()
+        assert len(self.sut.body) == 5
+
+    def test_search_in_view(self):
+        self.sut.filter('ap', self.match)
+        index = self.sut.search(lambda row: row == 'grape', 'forward')
+
+        assert index == 2
+
+    def test_set_refilters(self):
+        self.sut.filter('ap', self.match)
+        self.sut.set(['cape', 'dog', 'map'])
+
+        assert [self.sut.body[p].text for p in range(len(self.sut.body))] == ['cape', 'map']
+
+    def test_walker_body(self):
+        sut = MappedList(urwid.SimpleFocusListWalker(
+            [urwid.SelectableIcon(row) for row in self.rows]
+        ))
+        sut.filter('ap', key=lambda widget: widget.text)
+        sut.unfiltered.append(urwid.SelectableIcon('map'))
+
+        assert len(sut.body) == 5
+        assert sut.body[4].text == 'map'
+
+
+class TestMappedListFuzzy:
+    def setup_method(self):
+        self.rows = ['src/main.py', 'docs/index.md', 'setup.py', 'src/util/main_test.py']
+        self.sut = MappedList(self.rows, factory=urwid.SelectableIcon)
+
+    def test_focuses_best_match(self):
+        ranked = self.sut.fuzzy_search('mainpy')
+
+        assert ranked == [0, 3]
+        assert self.sut.focus_position == 0
+
+    def test_next_prev_in_list_order(self):
+        assert self.sut.fuzzy_search('py') == [2, 0, 3]
+        self.sut.next()
+        assert self.sut.focus_position == 3
+        self.sut.next()
+        assert self.sut.focus_position == 0
+        self.sut.prev()
+        assert self.sut.focus_position == 3
+
+    def test_index_reused_until_rows_change(self):
+        self.sut.fuzzy_search('py')
+        index = self.sut._fuzzy
+        self.sut.fuzzy_search('md')
+        assert self.sut._fuzzy is index
+
+        self.sut.set(['a.md', 'b.py'])
+        assert self.sut.fuzzy_search('py') == [1]
+
+    def test_in_filtered_view(self):
+        self.sut.filter('src')
+        assert self.sut.fuzzy_search('test') == [1]
+        assert self.sut.original_position() == 3
+
+    def test_key(self):
+        sut = MappedList(urwid.SimpleFocusListWalker(
+            [urwid.SelectableIcon(row) for row in self.rows]
+        ))
+        assert sut.fuzzy_search('dcs', key=lambda widget: widget.text) == [1]
+        assert sut.focus_position == 1
+
+
+class TestMappedListExtend:
+    def setup_method(self):
+        self.factory = Mock(side_effect=lambda row: urwid.SelectableIcon(str(row)))
+        self.rows = utility.RingBuffer(range(10), max_rows=10)
+        self.sut = MappedList(self.rows, factory=self.factory)
+        self.sut.render((20, 5), focus=True)
+
+    def test_focus_stays_on_row(self):
+        self.sut.set_focus(5)
+        self.sut.extend([10, 11, 12])
+
+        assert len(self.sut.body) == 10
+        assert self.sut.focus.text == '5'
+        assert self.sut.focus_position == 2
+
+    def test_focus_on_evicted_row(self):
+        self.sut.set_focus(1)
+        self.sut.extend(range(10, 15))
+
+        assert self.sut.focus.text == '5'
+
+    def test_follow(self):
+        self.sut.follow = True
+        self.sut.bottom()
+        self.sut.extend([10, 11])
+
+        assert self.sut.focus.text == '11'
+        self.sut.shiftUp()
+        self.sut.extend([12])
+        assert self.sut.focus.text == '10'
+
+    def test_widgets_reused_after_eviction(self):
+        self.sut.set_focus(5)
+        self.sut.render((20, 5), focus=True)
+        self.factory.reset_mock()
+        self.sut.extend([10])
+        self.sut.render((20, 5), focus=True)
+
+        assert self.factory.call_count <= 1
+
+    def test_search_index(self):
+        self.sut.set_search_index(lambda row: row)
+        self.sut.extend([10, 11])
+
+        assert self.sut.search_index.keys == range(2, 12)
+        assert self.sut.search(lambda row: row == 11, 'forward') == 9
+
+    def test_walker(self):
+        sut = MappedList(urwid.SimpleFocusListWalker([]), follow=True)
+        sut.extend([urwid.SelectableIcon('a'), urwid.SelectableIcon('b')])
+
+        assert sut.focus.text == 'b'
+
+    def test_filtered_checks_new_rows_only(self):
+        match = Mock(side_effect=lambda query, row: row % 2 == 0)
+        self.sut.filter('even', match)
+        self.sut.set_focus(2)
+        match.reset_mock()
+        self.sut.extend([10, 11, 12])
+
+        assert match.call_count == 3
+        assert [self.sut.body[p].text for p in range(len(self.sut.body))] == \
+            ['4', '6', '8', '10', '12']
+        assert self.sut.focus.text == '4'
+
+    def test_filtered_cached_results_follow_eviction(self):
+        match = Mock(side_effect=lambda query, row: str(row).endswith(query))
+        self.sut.filter('1', match)
+        self.sut.filter('11', match)
+        self.sut.extend([10, 11])
+        match.reset_mock()
+
+        self.sut.filter('1', match)
+        assert not match.called
+        assert [self.sut.original_position(p) for p in range(len(self.sut.body))] == [9]
+        assert self.sut.focus.text == '11'
+
+
+class TestRowStream:
+    def setup_method(self):
+        self.loop = Mock()
+        self.sut = MappedList(utility.RingBuffer(max_rows=100), factory=urwid.Text)
+
+    def flush(self):
+        callback = self.loop.set_alarm_in.call_args[0][1]
+        self.loop.set_alarm_in.reset_mock()
+        callback(self.loop, None)
+
+    def test_queue_batches(self):
+        queue = Queue.Queue()
+        stream = self.sut.stream(queue, self.loop, batch_size=3)
+        for row in range(5):
+            queue.put(str(row))
+        queue.put(RowStream.END)
+
+        self.flush()
+        assert len(self.sut.body) == 3
+        self.flush()
+        assert len(self.sut.body) == 5
+        assert stream.finished
+        assert not self.loop.set_alarm_in.called
+
+    def test_fd(self):
+        read, write = os.pipe()
+        stream = self.sut.stream(read, self.loop)
+        reader = self.loop.watch_file.call_args[0][1]
+        os.write(write, 'one\ntw')
+        reader()
+        os.write(write, 'o\nthree')
+        reader()
+        os.close(write)
+        reader()
+        self.flush()
+
+        assert list(self.sut.body.source) == ['one', 'two', 'three']
+        assert stream.finished
+        self.loop.remove_watch_file.assert_called_once_with(read)
+        os.close(read)
+
+    def test_iterable(self):
+        stream = self.sut.stream(('row %d' % n for n in range(250)), self.loop)
+        for _ in range(100):
+            self.flush()
+            if stream.finished:
+                break
+            time.sleep(0.01)
+
+        assert len(self.sut.body) == 100
+        assert self.sut.body.source[0] == 'row 150'
+
+    def test_iterable_backlog_bounded(self):
+        read = []
+        def rows():
+            for n in xrange(1000):
+                read.append(n)
+                yield str(n)
+        stream = self.sut.stream(rows(), self.loop, batch_size=10,
+                                 max_pending=20)
+        time.sleep(0.1)
+        assert len(read) <= 22
+
+        self.flush()
+        time.sleep(0.1)
+        assert len(self.sut.body) == 10
+        assert len(read) <= 32
+        stream.stop()
+
+    def test_fd_paused_while_behind(self):
+        read, write = os.pipe()
+        stream = self.sut.stream(read, self.loop, batch_size=2, max_pending=3)
+        reader = self.loop.watch_file.call_args[0][1]
+        os.write(write, 'a\nb\nc\nd\n')
+        reader()
+        self.loop.remove_watch_file.assert_called_once_with(read)
+
+        self.loop.watch_file.reset_mock()
+        self.flush()
+        assert self.loop.watch_file.called
+        assert list(self.sut.body.source) == ['a', 'b']
+        stream.stop()
+        os.close(write)
+        os.close(read)
+
+    def test_stop(self):
+        stream = self.sut.stream(Queue.Queue(), self.loop)
+        stream.stop()
+
+        assert self.loop.remove_alarm.called
+
+
+class TestMappedListUpdate:
+    def setup_method(self):
+        self.widgets = dict(
+            (name, urwid.SelectableIcon(name)) for name in 'abcdefg'
+        )
+        self.sut = MappedList(urwid.SimpleFocusListWalker(
+            [self.widgets[name] for name in 'abcde']
+        ))
+
+    def texts(self):
+        return ''.join(widget.text for widget in self.sut.body)
+
+    def test_reuses_widgets(self):
+        new = [urwid.SelectableIcon(name) for name in 'abxde']
+        self.sut.update(new, key=lambda widget: widget.text)
+
+        assert self.texts() == 'abxde'
+        assert self.sut.body[0] is self.widgets['a']
+        assert self.sut.body[2] is new[2]
+
+    def test_reuses_moved_widgets(self):
+        new = [urwid.SelectableIcon(name) for name in 'bcdea']
+        self.sut.update(new, key=lambda widget: widget.text)
+
+        assert self.texts() == 'bcdea'
+        assert self.sut.body[4] is self.widgets['a']
+
+    def test_focus_follows_key(self):
+        self.sut.set_focus(3)
+        self.sut.update(
+            [urwid.SelectableIcon(name) for name in 'fgde'],
+            key=lambda widget: widget.text
+        )
+
+        assert self.sut.focus.text == 'd'
+        assert self.sut.focus_position == 2
+        assert self.sut.scroll() == 2
+
+    def test_focus_on_removed_row(self):
+        self.sut.set_focus(2)
+        self.sut.update(
+            [urwid.SelectableIcon(name) for name in 'abde'],
+            key=lambda widget: widget.text
+        )
+
+        assert self.sut.focus.text == 'd'
+
+    def test_only_changes_are_applied(self):
+        modified = Mock(return_value=None)
+        self.sut.body.set_validate_contents_modified(modified)
+        self.sut.update(
+            [urwid.SelectableIcon(name) for name in 'abcdef'],
+            key=lambda widget: widget.text
+        )
+
+        modified.assert_called_once()
+        assert modified.call_args[0][0][:2] == (5, 5)
+
+
+class TestMappedListUpdateVirtual:
+    def setup_method(self):
+        self.factory = Mock(side_effect=lambda row: urwid.SelectableIcon(row[1]))
+        self.rows = [(n, 'row %d' % n) for n in range(100)]
+        self.sut = MappedList(self.rows, factory=self.factory)
+        self.sut.render((20, 10), focus=True)
+
+    def test_widgets_kept(self):
+        self.factory.reset_mock()
+        rows = [(-1, 'new')] + self.rows[:5] + self.rows[6:]
+        self.sut.update(rows, key=lambda row: row[0])
+        self.sut.render((20, 10), focus=True)
+
+        # Only the inserted row is built
+        assert self.factory.call_count == 1
+        assert self.sut.focus.text == 'row 0'
+        assert self.sut.focus_position == 1
+
+    def test_changed_row_rebuilt(self):
+        rows = list(self.rows)
+        rows[1] = (1, 'changed')
+        self.sut.set_search_index(lambda row: row[1])
+        self.sut.update(rows, key=lambda row: row[0])
+
+        assert self.sut.body[1].text == 'changed'
+        assert self.sut.search_index.keys[:2] == ['row 0', 'changed']
+
+    def test_search_index(self):
+        self.sut.set_search_index(lambda row: row[1])
+        rows = self.rows[10:] + [(200, 'last')]
+        self.sut.update(rows, key=lambda row: row[0])
+
+        assert self.sut.search_index.keys == [row[1] for row in rows]
+
+
+class TestMappedPileUpdate:
+    def setup_method(self):
+        self.widgets = [urwid.SelectableIcon(name) for name in 'abcd']
+        self.key = lambda widget: widget.text
+
+    def test_pile(self):
+        sut = MappedPile(list(self.widgets))
+        sut.focus_position = 2
+        new = [urwid.SelectableIcon(name) for name in 'xbcd']
+        sut.update(new, key=self.key)
+
+        assert [w.text for w, o in sut.contents] == list('xbcd')
+        assert sut.contents[1][0] is self.widgets[1]
+        assert sut.focus_position == 2
+        assert sut.selectable_positions() == [0, 1, 2, 3]
+
+    def test_titled_pile(self):
+        title = urwid.Text('title')
+        sut = TitledPile(title, list(self.widgets))
+        sut.focus_position = 4
+        sut.update([urwid.SelectableIcon(name) for name in 'dab'], key=self.key)
+
+        assert sut.contents[0][0] is title
+        assert [w.text for w, o in sut.contents[1:]] == list('dab')
+        assert sut.focus.text == 'd'
+        assert sut.contents[1][0] is self.widgets[3]
+
+
+class TestMappedListRowStore:
+    def setup_method(self):
+        self.store = utility.RowStore.from_rows('row %d' % n for n in range(1000))
+        self.factory = Mock(side_effect=urwid.Text)
+        self.sut = MappedList(self.store, factory=self.factory)
+
+    def test_rows_built_when_shown(self):
+        self.sut.render((20, 10), focus=True)
+
+        assert self.factory.call_count == 10
+        assert self.sut.focus.text == 'row 0'
+
+    def test_search_scans_buffer(self, monkeypatch):
+        rows = Mock(side_effect=AssertionError('row made'))
+        monkeypatch.setattr(utility.RowStore, '__getitem__', rows)
+
+        assert self.sut.search('row 999', 'forward', start=0) == 999
+        assert self.sut.search(re.compile('^row 12$'), 'backward', start=0) == 12
+
+    def test_next(self):
+        self.sut.search('5', 'forward')
+        self.sut.next()
+        self.sut.next()
+        assert self.sut.focus_position == 15
+        self.sut.prev()
+        assert self.sut.focus_position == 5
+
+    def test_inc_search(self):
+        self.sut.inc_search('row 50', 'forward')
+        assert self.sut.focus_position == 50
+
+    def test_search_with_key(self):
+        assert self.sut.search('7', 'forward', key=lambda row: row[-1]) == 7
+
+    def test_unicode_patterns(self):
+        store = utility.RowStore.from_rows([u'caf\xe9', u'tea', u'\xe9t\xe9'],
+                                           encoding='utf-8')
+        sut = MappedList(store, factory=urwid.Text)
+        assert sut.search(u'tea', 'forward', start=0) == 1
+        assert sut.search(re.compile(u'\xe9$'), 'forward', start=1) == 2
+        assert sut.select_matches(re.compile(u'^\xe9')) == 1
+        assert list(sut.selected()) == [2]
+
+
+class TestMappedListSelection:
+    def setup_method(self):
+        self.body = urwid.SimpleFocusListWalker(
+            [urwid.Text('row %d' % n) for n in range(10)]
+        )
+        self.sut = MappedList(self.body)
+
+    def test_toggle(self):
+        self.sut.toggle_selection()
+        self.sut.toggle_selection(3)
+        assert list(self.sut.selected()) == [0, 3]
+        self.sut.toggle_selection(3)
+        assert list(self.sut.selected()) == [0]
+
+    def test_bulk(self):
+        self.sut.select_all()
+        assert self.sut.selection.count() == 10
+        self.sut.select_none()
+        self.sut.toggle_selection(2)
+        self.sut.invert_selection()
+        assert 2 not in self.sut.selection
+        assert self.sut.selection.count() == 9
+
+    def test_select_matches(self):
+        count = self.sut.select_matches(lambda text: text.endswith('3'),
+                                        key=lambda widget: widget.text)
+        assert count == 1
+        assert list(self.sut.selected()) == [3]
+
+    def test_follows_rows(self):
+        self.sut.toggle_selection(3)
+        self.sut.toggle_selection(7)
+        del self.body[0]
+        self.body.insert(5, urwid.Text('new'))
+        assert list(self.sut.selected()) == [2, 7]
+        self.sut.set([urwid.Text('other')])
+        assert list(self.sut.selected()) == []
+
+    def test_filtered(self):
+        self.sut.filter('1', key=lambda widget: widget.text)
+        self.sut.select_all()
+        assert list(self.sut.selected()) == [1]
+        self.sut.invert_selection()
+        assert list(self.sut.selected()) == []
+        self.sut.toggle_selection(0)
+        assert list(self.sut.selected()) == [1]
+
+    def test_styled_at_render(self):
+        self.sut.toggle_selection(1)
+        canvas = self.sut.render((10, 3))
+        attrs = [row[0][0] for row in canvas.content()]
+        assert attrs == [None, 'selected', None]
+        assert self.body[1].render((10,)).content().next()[0][0] is None
+
+
+class TestMappedListSelectionVirtual:
+    def setup_method(self):
+        self.sut = MappedList(['row %d' % n for n in range(10)],
+                              factory=urwid.Text)
+
+    def test_update(self):
+        self.sut.toggle_selection(2)
+        self.sut.toggle_selection(5)
+        self.sut.update(['row %d' % n for n in range(3, 10)])
+        assert list(self.sut.selected()) == [2]
+
+    def test_extend_evicts(self):
+        sut = MappedList(utility.RingBuffer(['a', 'b', 'c'], max_rows=3),
+                         factory=urwid.Text)
+        sut.toggle_selection(1)
+        sut.extend(['d'])
+        assert list(sut.selected()) == [0]
+        assert len(sut.selection) == 3
+
+    def test_select_matches_index(self):
+        self.sut.set_search_index(lambda row: row)
+        assert self.sut.select_matches('row 1') == 1
+        assert list(self.sut.selected()) == [1]
+
+    def test_select_matches_rowstore(self, monkeypatch):
+        sut = MappedList(utility.RowStore.from_rows(['a', 'b', 'ab']),
+                         factory=urwid.Text)
+        monkeypatch.setattr(utility.RowStore, '__getitem__',
+                            Mock(side_effect=AssertionError('row made')))
+        assert sut.select_matches(re.compile('^a')) == 2
+        assert list(sut.selected()) == [0, 2]
+
+
+class TestMappedPileSelection:
+    def setup_method(self):
+        self.widgets = [urwid.SelectableIcon('item %d' % n) for n in range(4)]
+        self.sut = TitledPile(urwid.Text('title'), self.widgets)
+
+    def test_bulk(self):
+        self.sut.select_all()
+        assert list(self.sut.selected()) == [1, 2, 3, 4]
+        self.sut.toggle_selection(2)
+        self.sut.invert_selection()
+        assert list(self.sut.selected()) == [2]
+        self.sut.select_none()
+        assert self.sut.select_matches('3', key=lambda widget: widget.text) == 1
+        assert list(self.sut.selected()) == [4]
+
+    def test_follows_contents(self):
+        self.sut.toggle_selection(3)
+        del self.sut.contents[1]
+        assert list(self.sut.selected()) == [2]
+
+    def test_styled_at_render(self):
+        self.sut.toggle_selection(2)
+        canvas = self.sut.render((10,), focus=True)
+        attrs = [row[0][0] for row in canvas.content()]
+        assert attrs == [None, None, 'selected', None, None]
+        assert self.sut.contents[2][0] is self.widgets[1]
+
+    def test_styling_kept_between_renders(self):
+        self.sut.toggle_selection(2)
+        self.sut.render((10,), focus=True)
+        wrapper = self.sut._styled[2][2]
+        self.sut.toggle_selection(3)
+        self.sut.render((10,), focus=True)
+
+        assert self.sut._styled[2][2] is wrapper
+        self.sut.toggle_selection(2)
+        self.sut.render((10,), focus=True)
+        assert self.sut._styled.keys() == [3]
+
+
+class TestMappedWrapCanvas:
+    class Counted(urwid.Text):
+        renders = 0
+
+        def render(self, size, focus=False):
+            type(self).renders += 1
+            return super(TestMappedWrapCanvas.Counted, self).render(size, focus)
+
+    def setup_method(self):
+        self.Counted.renders = 0
+        self.sut = MappedWrap(self.Counted('row'), 'normal', 'focused')
+
+    def render(self, focus):
+        canvas = self.sut.render((10,), focus=focus)
+        return canvas.content().next()[0][0]
+
+    def test_focus_swaps_cached(self):
+        assert self.render(True) == 'focused'
+        assert self.render(False) == 'normal'
+        gc.collect()
+        renders = self.Counted.renders
+
+        assert self.render(True) == 'focused'
+        assert self.render(False) == 'normal'
+        assert self.Counted.renders == renders
+
+    def test_widget_change_renders_again(self):
+        self.render(True)
+        self.sut.set_text('changed')
+
+        canvas = self.sut.render((10,), focus=True)
+
+        assert canvas.text[0].rstrip() == 'changed'
+
+    def test_maps_reassigned(self):
+        self.render(True)
+        self.render(False)
+
+        self.sut.attrmap = 'other'
+        self.sut.focusmap = {None: 'other focused'}
+
+        assert self.render(False) == 'other'
+        assert self.render(True) == 'other focused'
+
+    def test_focus_moves_in_list(self):
+        sut = MappedList(urwid.SimpleFocusListWalker(
+            [MappedWrap(self.Counted('row %d' % n), 'normal', 'focused')
+             for n in range(5)]
+        ))
+        # The screen keeps the frame it last drew
+        screen = sut.render((10, 5), focus=True)
+        sut.keypress((10, 5), 'down')
+        screen = sut.render((10, 5), focus=True)
+        gc.collect()
+        renders = self.Counted.renders
+
+        sut.keypress((10, 5), 'up')
+        screen = sut.render((10, 5), focus=True)
+
+        assert self.Counted.renders == renders
+
+    def test_held_rows_bounded(self):
+        rows = [MappedWrap(self.Counted('row %d' % n), 'normal', 'focused')
+                for n in range(10)]
+        for row in rows:
+            row.render((10,), focus=True)
+            row.render((10,), focus=False)
+
+        assert MappedWrap._held.keys() == rows[-MappedWrap.held_rows:]
+
+    def test_widget_change_releases_canvases(self):
+        self.render(True)
+        self.render(False)
+        self.sut._widget.set_text('changed')
+
+        MappedWrap._release_stale()
+
+        assert MappedWrap._held[self.sut] == {}
+
+
+class TestMappedListSorted:
+    def setup_method(self):
+        self.rows = ['delta', 'alpha', 'charlie', 'bravo']
+        self.key = Mock(side_effect=lambda row: row)
+        self.length = Mock(side_effect=len)
+        self.sut = MappedList(list(self.rows), factory=urwid.Text,
+                              sort_key=self.key)
+
+    def test_sorted(self):
+        assert self.sut._rows() == ['alpha', 'bravo', 'charlie', 'delta']
+        assert self.sut.sort_key is self.key
+        assert self.sut.focus.text == 'delta'
+
+    def test_keys_cached(self):
+        self.sut.sort(self.length)
+        self.sut.sort(self.key)
+        self.sut.sort(self.length)
+
+        assert self.key.call_count == 4
+        assert self.length.call_count == 4
+        assert self.sut._rows() == ['alpha', 'bravo', 'delta', 'charlie']
+
+    def test_add(self):
+        assert self.sut.add('beta') == 1
+        self.sut.extend(['echo', 'aardvark'])
+        assert self.sut._rows() == ['aardvark', 'alpha', 'beta', 'bravo',
+                                    'charlie', 'delta', 'echo']
+        assert self.key.call_count == 7
+
+    def test_add_only_calls_current_key(self):
+        self.sut.sort(self.length)
+        self.sut.sort(self.key)
+        self.key.reset_mock()
+        self.length.reset_mock()
+
+        self.sut.add('echo')
+        assert self.key.call_count == 1
+        assert self.length.call_count == 0
+
+        self.sut.sort(self.length)
+        assert self.length.call_count == 1
+        assert self.sut._rows() == ['echo', 'alpha', 'bravo', 'delta', 'charlie']
+
+    def test_key_cache_bounded(self):
+        for _ in xrange(20):
+            self.sut.sort(lambda row: row[-1])
+        assert len(self.sut._sort_keys) <= 4
+        assert self.sut._sort_keys.keys()[-1] is self.sut.sort_key
+
+    def test_bounded_source_refused(self):
+        sut = MappedList(utility.RingBuffer(['b', 'a'], max_rows=2),
+                         factory=urwid.Text)
+        with pytest.raises(ValueError):
+            sut.sort(lambda row: row)
+        assert sut.sort_key is None
+
+    def test_add_keeps_focus(self):
+        self.sut.set_focus(2)
+        self.sut.add('beta')
+        assert self.sut.focus.text == 'charlie'
+
+    def test_focus_kept_across_sort(self):
+        self.sut.set_focus(1)
+        self.sut.sort(self.length)
+        assert self.sut.focus.text == 'bravo'
+        assert self.sut.scroll() == self.sut.focus_position
+
+    def test_set_and_update(self):
+        self.sut.set(['b', 'c', 'a'])
+        assert self.sut._rows() == ['a', 'b', 'c']
+        self.sut.update(['d', 'a', 'c'])
+        assert self.sut._rows() == ['a', 'c', 'd']
+
+    def test_search_in_sorted_order(self):
+        self.sut.set_search_index(lambda row: row)
+        self.sut.sort(self.length)
+        self.sut.top()
+        assert self.sut.search('a', 'forward') == 0
+        self.sut.next()
+        self.sut.next()
+        assert self.sut.focus.text == 'delta'
+
+    def test_selection_follows(self):
+        self.sut.toggle_selection(0)
+        self.sut.sort(self.length)
+        self.sut.add('a')
+        assert list(self.sut.selected()) == [1]
+        assert self.sut._rows()[1] == 'alpha'
+
+    def test_unsort(self):
+        self.sut.unsort()
+        self.sut.add('aardvark')
+        assert self.sut._rows()[-1] == 'aardvark'
+
+    def test_filtered(self):
+        self.sut.filter('a')
+        self.sut.set_focus(2)
+        assert self.sut.focus.text == 'charlie'
+        self.sut.sort(self.length)
+        assert self.sut.focus.text == 'charlie'
+        self.sut.add('aa')
+        assert self.sut.focus.text == 'charlie'
+        self.sut.unfilter()
+        assert self.sut._rows() == ['aa', 'alpha', 'bravo', 'delta', 'charlie']
+
+
+class TestMappedListSortedWalker:
+    def setup_method(self):
+        self.body = urwid.SimpleFocusListWalker(
+            [urwid.Text(text) for text in ('delta', 'alpha', 'charlie')]
+        )
+        self.sut = MappedList(self.body, sort_key=lambda widget: widget.text)
+
+    def texts(self):
+        return [widget.text for widget in self.body]
+
+    def test_sorted(self):
+        assert self.texts() == ['alpha', 'charlie', 'delta']
+        assert self.sut.add(urwid.Text('bravo')) == 1
+        assert self.texts() == ['alpha', 'bravo', 'charlie', 'delta']
+
+    def test_selection_and_focus_follow(self):
+        self.sut.set_focus(2)
+        self.sut.toggle_selection(0)
+        self.sut.sort(lambda widget: widget.text[-1])
+        assert self.texts() == ['alpha', 'delta', 'charlie']
+        assert list(self.sut.selected()) == [0]
+        assert self.sut.focus.text == 'delta'
+        self.sut.add(urwid.Text('echo'))
+        assert self.sut.focus.text == 'delta'
+
+
+class TestTitledPileCollapse:
+    def setup_method(self):
+        self.widgets = [urwid.SelectableIcon('item %d' % n) for n in range(3)]
+        self.factory = Mock(return_value=self.widgets)
+        self.sut = TitledPile(urwid.Text('title'), factory=self.factory,
+                              collapsed=True)
+
+    def test_collapsed_shows_title(self):
+        canvas = self.sut.render((10,), focus=True)
+
+        assert canvas.text == ['title     ']
+        assert self.sut.selectable()
+        assert self.sut.selectable_positions() == []
+        self.factory.assert_not_called()
+
+    def test_built_on_first_expand(self):
+        self.sut.expand()
+        self.sut.collapse()
+        self.sut.expand()
+
+        self.factory.assert_called_once_with()
+        assert len(self.sut.render((10,)).text) == 4
+        assert self.sut.focus_position == 1
+
+    def test_constraint_skipped(self):
+        constraint = Mock(return_value=True)
+        sut = TitledPile(urwid.Text('title'), self.widgets,
+                         constraint=constraint, collapsed=True)
+
+        sut.selectable_positions()
+
+        assert constraint.call_count == 1
+
+    def test_selection_kept(self):
+        self.sut.expand()
+        self.sut.toggle_selection(2)
+        self.sut.collapse()
+        assert list(self.sut.selected()) == []
+        self.sut.expand()
+        assert list(self.sut.selected()) == [2]
+
+    def test_changed_while_collapsed(self):
+        self.sut.expand()
+        self.sut.toggle_selection(2)
+        self.sut.collapse()
+        new = urwid.SelectableIcon('new')
+        self.sut.update([new] + self.widgets[1:], key=lambda widget: widget.text)
+        self.sut.add(urwid.SelectableIcon('last'))
+        self.sut.toggle()
+
+        assert [widget.text for widget, options in self.sut.contents] == \
+            ['title', 'new', 'item 1', 'item 2', 'last']
+        assert self.sut.contents[2][0] is self.widgets[1]
+        assert list(self.sut.selected()) == [2]
+
+    def test_keys_while_collapsed(self):
+        callback = Mock(return_value=None)
+        self.sut.keymap = {'enter': callback}
+
+        assert self.sut.keypress((10,), 'down') == 'down'
+        assert self.sut.keypress((10,), 'enter') is None
+        callback.assert_called_once_with()
+
+    def test_signals(self):
+        collapse, expand = Mock(), Mock()
+        urwid.connect_signal(self.sut, 'collapse', collapse)
+        urwid.connect_signal(self.sut, 'expand', expand)
+
+        self.sut.toggle()
+        self.sut.toggle()
+
+        expand.assert_called_once_with(self.sut)
+        collapse.assert_called_once_with(self.sut)
+
+
+class TestMappedPileSections:
+    def setup_method(self):
+        self.sections = [
+            TitledPile(urwid.Text('section %d' % n),
+                       [urwid.SelectableIcon('%d.%d' % (n, m)) for m in range(3)],
+                       collapsed=True)
+            for n in range(3)
+        ]
+        self.sut = MappedPile(self.sections)
+
+    def test_collapsed_sections_are_one_step(self):
+        self.sut.top()
+        self.sut.shiftDown()
+        assert self.sut.focus_position == 1
+        self.sut.bottom()
+        assert self.sut.focus_position == 2
+
+    def test_keypress_skips_collapsed(self):
+        self.sections[1].expand()
+        self.sut.render((10,), focus=True)
+
+        self.sut.keypress((10,), 'down')
+        self.sut.keypress((10,), 'down')
+
+        assert self.sut.focus_position == 1
+        assert self.sections[1].focus_position == 2
+
+    def test_index_refreshed(self):
+        empty = TitledPile(urwid.Text('empty'), collapsed=True)
+        self.sut.add(empty)
+        assert self.sut.selectable_positions() == [0, 1, 2, 3]
+
+        empty.expand()
+        assert self.sut.selectable_positions() == [0, 1, 2]
+
+        del self.sut.contents[3]
+        empty.collapse()
+        assert self.sut.selectable_positions() == [0, 1, 2]
+
+    def test_child_becoming_selectable(self):
+        empty = TitledPile(urwid.Text('a'), [])
+        sut = MappedPile([empty, TitledPile(urwid.Text('b'), [urwid.Edit()])])
+        sut.focus_position = 1
+        assert sut.selectable_positions() == [1]
+
+        empty.add(urwid.Edit())
+        assert sut.selectable_positions() == [0, 1]
+        sut.shiftUp()
+        assert sut.focus_position == 0
+
+        del empty.contents[1]
+        assert sut.selectable_positions() == [1]
+
+    def test_nested_piles(self):
+        inner = MappedPile([urwid.Text('x')])
+        middle = MappedPile([inner])
+        sut = MappedPile([urwid.Text('title'), middle])
+        assert sut.selectable_positions() == []
+
+        inner.add(urwid.Edit())
+        assert sut.selectable_positions() == [1]
+
+
+class TestMappedListUntracked:
+    def test_search_index_refused(self):
+        sut = MappedList(urwid.SimpleListWalker([urwid.Text('a')]))
+        with pytest.raises(ValueError):
+            sut.set_search_index(lambda widget: widget.text)
+        with pytest.raises(ValueError):
+            MappedList(urwid.SimpleListWalker([]), index_key=lambda x: x)
+
+    def test_selection_refused(self):
+        sut = MappedList(urwid.SimpleListWalker([urwid.Text('a')]))
+        with pytest.raises(ValueError):
+            sut.toggle_selection()
+        with pytest.raises(ValueError):
+            sut.select_all()
+        assert list(sut.selected()) == []
+
+
+class TestSelectionThroughUpdate:
+    def test_list(self):
+        sut = MappedList(urwid.SimpleFocusListWalker(
+            [urwid.Text(str(n)) for n in range(1, 6)]
+        ))
+        widgets = dict((widget.text, widget) for widget in sut.body)
+        sut.toggle_selection(1)
+        sut.toggle_selection(4)
+        sut.update([widgets[text] for text in '51234'],
+                   key=lambda widget: widget.text)
+        assert [sut.body[index].text for index in sut.selected()] == ['5', '2']
+
+    def test_virtual(self):
+        sut = MappedList(range(1, 6), factory=lambda row: urwid.Text(str(row)))
+        sut.toggle_selection(1)
+        sut.toggle_selection(4)
+        sut.update([5, 1, 2, 3, 4])
+        assert list(sut.selected()) == [0, 2]
+
+    def test_pile(self):
+        widgets = [urwid.SelectableIcon(str(n)) for n in range(1, 6)]
+        sut = TitledPile(urwid.Text('title'), widgets)
+        sut.toggle_selection(2)
+        sut.toggle_selection(5)
+        sut.update([widgets[4]] + widgets[:4])
+        assert list(sut.selected()) == [1, 3]
+
@@ -0,0 +1,372 @@
+import threading
+import time
+import pytest
+from mock import Mock
+from urwidgets import utility
+
+
+def double(value, factor=2):
+    return value * factor
+
+
+class TestCheckArguments:
+    def test_accepts(self):
+        utility.check_arguments(double, 1)
+        utility.check_arguments(double, 2)
+
+    def test_too_many(self):
+        with pytest.raises(TypeError):
+            utility.check_arguments(double, 3)
+
+    def test_too_few(self):
+        with pytest.raises(TypeError):
+            utility.check_arguments(double, 0)
+
+    def test_varargs(self):
+        utility.check_arguments(lambda *args: None, 10)
+
+    def test_bound_method(self):
+        utility.check_arguments(TestCheckArguments().test_accepts, 0)
+
+    def test_not_introspectable(self):
+        utility.check_arguments(Mock(), 5)
+
+
+class TestCompletionIndex:
+    def setup_method(self):
+        self.words = ('yesterday', 'Yellow', 'yes', 'no', 'yeti', 'noon')
+        self.sut = utility.CompletionIndex(self.words)
+
+    def test_complete_common_prefix(self):
+        text, hits = self.sut.complete('yes')
+
+        assert text == 'yes'
+        assert hits == ('yes', 'yesterday')
+
+    def test_complete_case_insensitive(self):
+        text, hits = self.sut.complete('YE')
+
+        assert hits == ('YEllow', 'YEs', 'YEsterday', 'YEti')
+
+    def test_complete_extends(self):
+        text, hits = self.sut.complete('n')
+
+        assert text == 'no'
+        assert hits == ('no', 'noon')
+
+    def test_complete_no_hits(self):
+        assert self.sut.complete('x') == ('x', ())
+
+    def test_matches_plain_complete(self):
+        for prefix in ('', 'y', 'yes', 'no', 'noo', 'z'):
+            assert (
+                self.sut.complete(prefix)[0] ==
+                utility.complete(self.words, prefix)[0]
+            )
+
+    def test_complete_accepts_index(self):
+        assert utility.complete(self.sut, 'yet') == ('yeti', ('yeti',))
+
+
+class TestFuzzyIndex:
+    def setup_method(self):
+        self.words = ['open_file', 'close', 'open-folder', 'reopen file', 'goto', 'Options']
+        self.sut = utility.FuzzyIndex(self.words)
+
+    def test_matches_in_order(self):
+        assert self.sut.matches('of') == [0, 2, 3]
+
+    def test_case_insensitive(self):
+        assert self.sut.matches('OPT') == [5]
+
+    def test_rank_tightest_first(self):
+        assert self.sut.hits('ofo') == ['open-folder']
+        assert self.sut.rank('op') == [5, 0, 2, 3]
+
+    def test_rank_limit(self):
+        assert self.sut.hits('o', limit=2) == ['Options', 'open_file']
+
+    def test_word_start_first(self):
+        sut = utility.FuzzyIndex(['xab', 'x_ab', 'a_b'])
+        assert sut.hits('ab') == ['x_ab', 'xab', 'a_b']
+
+    def test_empty_query(self):
+        assert sorted(self.sut.matches('')) == range(len(self.words))
+
+    def test_complete(self):
+        assert utility.complete(self.sut, 'gt') == ('goto', ('goto',))
+        text, hits = self.sut.complete('of')
+        assert text == 'of'
+        assert set(hits) == set(['open_file', 'open-folder', 'reopen file'])
+
+    def test_near_misses_linear(self):
+        # Many copies of the query's characters and no match used to
+        # backtrack exponentially
+        sut = utility.FuzzyIndex(['a' * 80] + ['x %s y' % ('-' * 70)] * 200)
+        start = time.time()
+        assert sut.rank('aaaaab') == []
+        assert sut.rank('------x') == []
+        assert len(sut.rank('--y')) == 200
+        assert time.time() - start < 1
+
+    def test_special_characters(self):
+        sut = utility.FuzzyIndex(['a-b]c^d', 'a]^'])
+        assert sut.hits(']^') == ['a]^', 'a-b]c^d']
+
+    def test_large(self):
+        sut = utility.FuzzyIndex('entry %06d' % n for n in xrange(200000))
+        assert sut.hits('e199999') == ['entry 199999']
+        assert len(sut.rank('e1999', limit=5)) == 5
+
+
+class TestCompletionSource:
+    def test_callable_memoized_per_arguments(self):
+        source = Mock(return_value=['alpha', 'beta'])
+        sut = utility.CompletionSource(source, background=False)
+
+        sut.index('host')
+        sut.index('host')
+        sut.index('other')
+
+        assert source.call_count == 2
+        source.assert_called_with('other')
+
+    def test_generator_consumed_once(self):
+        sut = utility.CompletionSource(
+            (word for word in ('alpha', 'beta')), ttl=0, background=False
+        )
+
+        sut.index()
+
+        assert sut.index().complete('a') == ('alpha', ('alpha',))
+
+    def test_generator_shared_by_arguments(self):
+        sut = utility.CompletionSource(
+            (word for word in ('alpha', 'beta')), background=False
+        )
+
+        assert sut.index('open').complete('a') == ('alpha', ('alpha',))
+        assert sut.index('close').complete('b') == ('beta', ('beta',))
+
+    def test_ttl_expires(self):
+        source = Mock(return_value=['alpha'])
+        sut = utility.CompletionSource(source, ttl=0, background=False)
+
+        sut.index()
+        sut.index()
+
+        assert source.call_count == 2
+
+    def test_lru_eviction(self):
+        source = Mock(return_value=['alpha'])
+        sut = utility.CompletionSource(source, max_entries=1, background=False)
+
+        sut.index('a')
+        sut.index('b')
+        sut.index('a')
+
+        assert source.call_count == 3
+
+    def test_background_partial_results(self):
+        release = threading.Event()
+
+        def slow():
+            yield 'alpha'
+            release.wait()
+            yield 'alps'
+
+        sut = utility.CompletionSource(slow)
+        entry = sut.entry()
+        while not entry.items:
+            time.sleep(0.001)
+
+        assert entry.index().complete('al')[1] == ('alpha',)
+        release.set()
+        while not entry.done:
+            time.sleep(0.001)
+        assert entry.index().complete('al')[1] == ('alpha', 'alps')
+
+    def test_source_errors_are_kept(self):
+        def broken():
+            raise IOError('gone')
+
+        entry = utility.CompletionSource(broken, background=False).entry()
+
+        assert entry.done
+        assert isinstance(entry.error, IOError)
+
+
+class TestCursor:
+    def test_clamps(self):
+        sut = utility.Cursor(3)
+
+        assert sut() == 0
+        assert sut(-1) == 0
+        assert sut(5) == 2
+        assert sut(-1) == 1
+
+    def test_initial_position_clamped(self):
+        assert utility.Cursor(3, 10)() == 2
+
+    def test_empty(self):
+        sut = utility.Cursor(0)
+
+        assert sut(1) == 0
+        assert sut(-1) == 0
+
+    def test_reset(self):
+        sut = utility.Cursor(3, 2)
+        sut.reset(10, 7)
+
+        assert sut() == 7
+        assert sut(5) == 9
+
+
+class TestFrozenKeymap:
+    def test_immutable(self):
+        sut = utility.FrozenKeymap({'a': None})
+
+        with pytest.raises(TypeError):
+            sut['b'] = None
+        with pytest.raises(TypeError):
+            sut.update({'b': None})
+
+    def test_own_keymap(self):
+        frozen = utility.FrozenKeymap()
+        plain = {}
+
+        assert utility.own_keymap(frozen) is frozen
+        assert utility.own_keymap(plain) is not plain
+
+
+class TestRingBuffer:
+    def test_unbounded(self):
+        sut = utility.RingBuffer([1, 2])
+        assert sut.extend([3]) == 0
+        assert list(sut) == [1, 2, 3]
+
+    def test_evicts_oldest(self):
+        sut = utility.RingBuffer(range(3), max_rows=4)
+        assert sut.extend([3, 4, 5]) == 2
+        assert list(sut) == [2, 3, 4, 5]
+        assert [sut[i] for i in range(4)] == [2, 3, 4, 5]
+        assert sut[-1] == 5
+        assert sut.evicted == 2
+
+    def test_wraps(self):
+        sut = utility.RingBuffer(max_rows=3)
+        for row in range(10):
+            sut.extend([row])
+        assert list(sut) == [7, 8, 9]
+        assert sut.evicted == 7
+
+    def test_batch_larger_than_buffer(self):
+        sut = utility.RingBuffer([0, 1], max_rows=3)
+        assert sut.extend(range(2, 10)) == 7
+        assert list(sut) == [7, 8, 9]
+
+    def test_index_error(self):
+        with pytest.raises(IndexError):
+            utility.RingBuffer([1], max_rows=2)[1]
+
+
+class TestSelection:
+    def setup_method(self):
+        self.sut = utility.Selection(6)
+
+    def test_toggle(self):
+        self.sut.add(1)
+        self.sut.toggle(4)
+        self.sut.toggle(1)
+        assert list(self.sut) == [4]
+        assert 4 in self.sut
+        assert 6 not in self.sut
+
+    def test_bulk(self):
+        assert not self.sut.any()
+        self.sut.select_all()
+        assert self.sut.count() == 6
+        self.sut.toggle_all([0, 2])
+        assert list(self.sut) == [1, 3, 4, 5]
+        self.sut.invert()
+        assert list(self.sut) == [0, 2]
+        self.sut.clear()
+        assert not self.sut.any()
+        assert len(self.sut) == 6
+
+    def test_replace(self):
+        self.sut.update([1, 3, 5])
+        self.sut.replace(2, 2, 2)
+        assert list(self.sut) == [1, 5, 7]
+        self.sut.replace(0, 2, 0)
+        assert list(self.sut) == [3, 5]
+        self.sut.replace(0, 6, 3, 2)
+        assert list(self.sut) == [3, 5]
+        self.sut.replace(1, 6, 0, 2)
+        assert list(self.sut) == []
+        assert len(self.sut) == 3
+
+
+class TestRowStore:
+    def setup_method(self):
+        self.rows = ['alpha', '', 'beta gamma', 'delta', 'alphabet']
+        self.sut = utility.RowStore.from_rows(self.rows)
+
+    def test_rows(self):
+        assert len(self.sut) == 5
+        assert list(self.sut) == self.rows
+        assert self.sut[-1] == 'alphabet'
+        with pytest.raises(IndexError):
+            self.sut[5]
+
+    def test_no_trailing_newline(self):
+        sut = utility.RowStore('one\ntwo')
+        assert list(sut) == ['one', 'two']
+        assert list(utility.RowStore('')) == []
+
+    def test_encoding(self):
+        sut = utility.RowStore.from_rows([u'caf\xe9'], encoding='utf-8')
+        assert sut[0] == u'caf\xe9'
+
+    def test_encoded_patterns(self):
+        import re
+        sut = utility.RowStore.from_rows([u'caf\xe9', u'tea'], encoding='utf-8')
+        assert sut.find(u'tea', 0, 'forward') == 1
+        assert sut.find(u'\xe9', 1, 'forward') == 0
+        assert sut.find(re.compile(u'^t'), 0, 'forward') == 1
+        assert sut.matches(u'a') == [0, 1]
+        assert not sut.scannable(re.compile(u'\xe9'))
+        assert not utility.RowStore.from_rows(['x']).scannable(u'\xe9')
+
+    def test_find_string(self):
+        assert self.sut.find('alpha', 1, 'forward') == 4
+        assert self.sut.find('alpha', 4, 'backward') == 4
+        assert self.sut.find('alpha', 3, 'backward') == 0
+        assert self.sut.find('gamma', 3, 'forward') == 2
+        assert self.sut.find('zeta', 0, 'forward') is None
+
+    def test_find_regex(self):
+        import re
+        assert self.sut.find(re.compile('^d'), 0, 'forward') == 3
+        assert self.sut.find(re.compile('a$'), 3, 'backward') == 3
+        assert self.sut.find(re.compile('a\\s+b'), 0, 'forward') is None
+
+    def test_from_file(self, tmpdir):
+        path = tmpdir.join('rows.txt')
+        path.write('\n'.join(self.rows) + '\n')
+        sut = utility.RowStore.from_file(str(path))
+
+        assert list(sut) == self.rows
+        assert sut.find('delta', 0, 'forward') == 3
+        sut.close()
+
+    def test_matches(self):
+        import re
+        assert self.sut.matches('alpha') == [0, 4]
+        assert self.sut.matches(re.compile('a$')) == [0, 2, 3]
+        assert self.sut.matches('a\nb') == []
+
+    def test_as_predicate(self):
+        import re
+        assert utility.as_predicate('et')('beta')
+        assert not utility.as_predicate(re.compile('^et'))('beta')
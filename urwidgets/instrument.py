@@ -0,0 +1,170 @@
+import sys
+import time
+import functools
+import keymaps
+import urwidgets
+
+# Methods timed while instrumentation is enabled. Nothing is wrapped until
+# enable() is called, and disable() puts the originals back, so it costs
+# nothing when off.
+TIMED = {
+    'MappedEdit': ('keypress',),
+    'MappedWrap': ('keypress', 'render'),
+    'MappedList': ('keypress', 'render', 'search', 'inc_search', 'fuzzy_search',
+                   'next', 'prev'),
+    'MappedPile': ('keypress', 'render', 'selectable_positions'),
+    'CommandFrame': ('keypress', 'render', 'submit_command'),
+    'IncrementalSearch': ('update',),
+}
+
+BUCKETS = 32
+
+
+class Histogram(object):
+    # Bucket n counts the times under 2**n microseconds
+    __slots__ = ('buckets', 'count', 'total', 'low', 'high')
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = 0.0
+
+    def record(self, seconds):
+        micros = seconds * 1e6
+        self.buckets[min(int(micros).bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += micros
+        if self.low is None or micros < self.low:
+            self.low = micros
+        if micros > self.high:
+            self.high = micros
+
+    def percentile(self, percent):
+        # Upper bound of the bucket the percentile falls in
+        if not self.count:
+            return 0.0
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(float(2 ** bucket), self.high)
+        return self.high
+
+    def export(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.low or 0.0,
+            'max': self.high,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': list(self.buckets),
+        }
+
+
+class Recorder(object):
+    def __init__(self):
+        self.histograms = {}
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def record(self, name, seconds):
+        self.histogram(name).record(seconds)
+
+    def reset(self):
+        self.histograms.clear()
+
+    def export(self):
+        return dict(
+            (name, histogram.export())
+            for name, histogram in self.histograms.items()
+        )
+
+    def dump(self, stream=None):
+        stream = stream if stream is not None else sys.stderr
+        stream.write('%-36s %8s %10s %10s %10s %10s\n' % (
+            'name', 'count', 'mean us', 'p50 us', 'p99 us', 'max us'
+        ))
+        for name, stats in sorted(self.export().items()):
+            stream.write('%-36s %8d %10.1f %10.1f %10.1f %10.1f\n' % (
+                name, stats['count'], stats['mean'], stats['p50'],
+                stats['p99'], stats['max']
+            ))
+
+
+recorder = Recorder()
+_originals = []
+
+
+def label(widget):
+    # Widgets can be told apart by setting instrument_name on them
+    name = getattr(widget, 'instrument_name', None)
+    return name if name is not None else type(widget).__name__
+
+
+def _timed(method, name):
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            recorder.record('%s.%s' % (label(self), name), time.time() - start)
+    return timed
+
+
+def _timed_dispatch(dispatch):
+    # Keymap callbacks run inside dispatch; timed apart from the widget's
+    # own keypress handling
+    @functools.wraps(dispatch)
+    def timed(widget, keymap, key):
+        start = time.time()
+        try:
+            return dispatch(widget, keymap, key)
+        finally:
+            recorder.record('%s.keymap' % label(widget), time.time() - start)
+    return timed
+
+
+def _patch(owner, name, value):
+    # Inherited methods are patched onto the class itself and removed
+    # again on disable
+    _originals.append((owner, name, owner.__dict__.get(name)))
+    setattr(owner, name, value)
+
+
+def enabled():
+    return bool(_originals)
+
+
+def enable(into=None):
+    # Records into the module's recorder, or into `into` if given
+    global recorder
+    if into is not None:
+        recorder = into
+    if enabled():
+        return recorder
+    for class_name, methods in TIMED.items():
+        cls = getattr(urwidgets, class_name)
+        for name in methods:
+            _patch(cls, name, _timed(getattr(cls, name).__func__, name))
+    _patch(keymaps, 'dispatch', _timed_dispatch(keymaps.dispatch))
+    return recorder
+
+
+def disable():
+    while _originals:
+        owner, name, value = _originals.pop()
+        if value is None:
+            delattr(owner, name)
+        else:
+            setattr(owner, name, value)
@@ -0,0 +1,191 @@
+import time
+
+
+class Counted(object):
+    # An action that takes the count typed before its key (default 1)
+    # instead of being called that many times
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, count):
+        return self.func(count)
+
+def counted(func):
+    return Counted(func)
+
+
+class _Node(object):
+    __slots__ = ('children', 'action')
+
+    def __init__(self, children=None, action=None):
+        self.children = children if children is not None else {}
+        self.action = action
+
+    def copy(self):
+        return _Node(dict(self.children), self.action)
+
+    def bound(self):
+        return self.action is not None or bool(self.children)
+
+
+class _KeyState(object):
+    # Per widget, and only created once a widget is part way through a
+    # sequence or a count
+    __slots__ = ('node', 'count', 'time', 'alarm')
+
+    def __init__(self):
+        self.node = None
+        self.count = 0
+        self.time = 0
+        # (loop, handle) of the pending prefix's timeout, removed once the
+        # sequence ends
+        self.alarm = None
+
+
+class Keymap(object):
+    def __init__(self, bindings={}, parent=None, timeout=None, counts=None,
+                 loop=None):
+        # Bindings map a key, or a tuple of keys for a sequence, to an
+        # action. A child keymap starts from its parent's bindings and
+        # may override them, or unbind them with None. Keymaps can't be
+        # changed once built, so one can be shared by any number of widgets.
+        self.parent = parent
+        self.timeout = timeout if timeout is not None \
+            else (parent.timeout if parent is not None else 1.0)
+        self.counts = counts if counts is not None \
+            else (parent.counts if parent is not None else False)
+        self.loop = loop if loop is not None \
+            else (parent.loop if parent is not None else None)
+        self._root = parent._root.copy() if parent is not None else _Node()
+        for keys, action in bindings.items():
+            self._bind(keys, action)
+
+    def _bind(self, keys, action):
+        if isinstance(keys, basestring):
+            keys = (keys,)
+        node = self._root
+        for key in keys:
+            child = node.children.get(key)
+            child = child.copy() if child is not None else _Node()
+            node.children[key] = child
+            node = child
+        node.action = action
+
+    def extend(self, bindings, **kwargs):
+        return Keymap(bindings, parent=self, **kwargs)
+
+    def __contains__(self, key):
+        child = self._root.children.get(key)
+        return child is not None and child.bound()
+
+    def __getitem__(self, keys):
+        if isinstance(keys, basestring):
+            keys = (keys,)
+        node = self._root
+        for key in keys:
+            node = node.children[key]
+        if node.action is None:
+            raise KeyError(keys)
+        return node.action
+
+    def _state(self, widget):
+        state = widget.__dict__.get('_keystate')
+        if state is None:
+            state = widget.__dict__['_keystate'] = _KeyState()
+        return state
+
+    def dispatch(self, widget, key):
+        # Returns (handled, key): whether the keymap used the key, and
+        # what to pass on, which is the action's result when it ran one
+        if key is None:
+            # The widget already used the key
+            return (False, key)
+        state = widget.__dict__.get('_keystate')
+        if state is not None and state.node is not None:
+            if time.time() - state.time > self.timeout:
+                self.resolve(widget)
+            else:
+                child = state.node.children.get(key)
+                if child is not None and child.bound():
+                    return self._enter(widget, state, child)
+                # Not a continuation: finish what was pending, then treat
+                # key as a fresh press
+                self.resolve(widget)
+
+        child = self._root.children.get(key)
+        if child is None or not child.bound():
+            if self.counts and key.isdigit() \
+                    and (key != '0' or (state is not None and state.count)):
+                state = self._state(widget)
+                state.count = state.count * 10 + int(key)
+                state.time = time.time()
+                return (True, None)
+            if state is not None:
+                state.count = 0
+            return (False, key)
+        return self._enter(widget, state, child)
+
+    def _enter(self, widget, state, node):
+        if not node.children:
+            return (True, self._fire(state, node.action))
+
+        state = state if state is not None else self._state(widget)
+        self._cancel(state)
+        state.node = node
+        state.time = time.time()
+        if node.action is not None and self.loop is not None:
+            # Ambiguous prefix: run its own action if nothing follows
+            state.alarm = (self.loop, self.loop.set_alarm_in(
+                self.timeout, lambda loop, data: self._expired(widget, state)
+            ))
+        return (True, None)
+
+    def _expired(self, widget, state):
+        state.alarm = None
+        self.resolve(widget)
+
+    def _cancel(self, state):
+        if state.alarm is not None:
+            loop, handle = state.alarm
+            loop.remove_alarm(handle)
+            state.alarm = None
+
+    def resolve(self, widget, node=None):
+        # Ends a pending sequence, running the action bound to the keys
+        # typed so far if there is one
+        state = widget.__dict__.get('_keystate')
+        if state is None or state.node is None:
+            return None
+        if node is not None and state.node is not node:
+            return None
+        self._cancel(state)
+        action = state.node.action
+        state.node = None
+        if action is None:
+            state.count = 0
+            return None
+        return self._fire(state, action)
+
+    def _fire(self, state, action):
+        count = 1
+        if state is not None:
+            count = state.count or 1
+            self._cancel(state)
+            state.node = None
+            state.count = 0
+        if isinstance(action, Counted):
+            return action(count)
+        result = None
+        for _ in xrange(count):
+            result = action()
+        return result
+
+def dispatch(widget, keymap, key):
+    # For plain dict keymaps as well as Keymap objects
+    if isinstance(keymap, Keymap):
+        return keymap.dispatch(widget, key)
+    if key in keymap:
+        return (True, keymap[key]())
+    return (False, key)
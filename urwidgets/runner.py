@@ -0,0 +1,241 @@
+import os
+import time
+import collections
+import inspect
+import threading
+import multiprocessing
+import Queue
+import utility
+
+
+def in_thread(func):
+    func.run_in = 'thread'
+    return func
+
+def in_process(func):
+    # func must be picklable, i.e. defined at module level
+    func.run_in = 'process'
+    return func
+
+def run_mode(func):
+    mode = getattr(func, 'run_in', None)
+    if mode in ('thread', 'process'):
+        return mode
+    if inspect.isgeneratorfunction(func):
+        return 'coroutine'
+    return None
+
+def _call_in_process(func, args):
+    # Pool.apply_async has no error callback in python2, so errors are
+    # returned alongside the result
+    try:
+        return func(*args), None
+    except Exception as error:
+        return None, error
+
+
+class Job(object):
+    def __init__(self, name, func, args, mode):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.mode = mode
+        self.cancelled = False
+        self.coroutine = None
+        self.alarm = None
+
+
+class CommandRunner(object):
+    def __init__(self, loop, report, max_workers=4, interval=0.001):
+        # report is called on the main loop with a status string whenever
+        # a command is queued, finishes, fails or is cancelled
+        self.loop = loop
+        self.report = report
+        self.max_workers = max_workers
+        self.interval = interval
+
+        self.pending = collections.deque()
+        self.running = []
+
+        self._finished = Queue.Queue()
+        self._pipe = loop.watch_pipe(self._collect)
+        self._pool = None
+
+    def accepts(self, func):
+        return run_mode(func) is not None
+
+    def submit(self, name, func, args):
+        job = Job(name, func, tuple(args), run_mode(func))
+        if job.mode == 'coroutine':
+            # Creating the generator checks the arguments right away
+            job.coroutine = func(*job.args)
+        else:
+            utility.check_arguments(func, len(job.args))
+
+        self.pending.append(job)
+        self._start()
+        if job in self.pending:
+            self.report("%s queued" % name)
+        return job
+
+    def cancel(self):
+        # Threads and processes can't be interrupted; their results are
+        # dropped when they come in, and they hold their slot until then
+        cancelled = list(self.pending) + self.running
+        self.pending.clear()
+        for job in cancelled:
+            job.cancelled = True
+            if job.mode == 'coroutine' and job in self.running:
+                if job.alarm is not None:
+                    self.loop.remove_alarm(job.alarm)
+                job.coroutine.close()
+                self.running.remove(job)
+        if cancelled:
+            self.report("Cancelled")
+        self._start()
+
+    def close(self):
+        self.cancel()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _start(self):
+        while self.pending and len(self.running) < self.max_workers:
+            job = self.pending.popleft()
+            self.running.append(job)
+            getattr(self, '_start_%s' % job.mode)(job)
+
+    def _start_thread(self, job):
+        def run():
+            try:
+                result = job.func(*job.args), None
+            except Exception as error:
+                result = None, error
+            self._finish(job, *result)
+
+        worker = threading.Thread(target=run)
+        worker.daemon = True
+        worker.start()
+
+    def _start_process(self, job):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.max_workers)
+        self._pool.apply_async(
+            _call_in_process, (job.func, job.args),
+            callback=lambda result: self._finish(job, *result)
+        )
+
+    def _start_coroutine(self, job):
+        def step(loop, user_data):
+            job.alarm = None
+            try:
+                job.coroutine.next()
+            except StopIteration:
+                self._done(job, None, None)
+            except Exception as error:
+                self._done(job, None, error)
+            else:
+                job.alarm = self.loop.set_alarm_in(self.interval, step)
+
+        job.alarm = self.loop.set_alarm_in(self.interval, step)
+
+    def _finish(self, job, result, error):
+        # Called from worker threads; hand over to the main loop
+        self._finished.put((job, result, error))
+        os.write(self._pipe, 'x')
+
+    def _collect(self, data):
+        while True:
+            try:
+                job, result, error = self._finished.get_nowait()
+            except Queue.Empty:
+                break
+            self._done(job, result, error)
+        return True
+
+    def _done(self, job, result, error):
+        if job in self.running:
+            self.running.remove(job)
+        if not job.cancelled:
+            if error is not None:
+                self.report("%s failed: %s" % (job.name, error))
+            else:
+                self.report("%s done" % job.name)
+        self._start()
+
+
+class UpdateChannel(object):
+    # Calls that replace a widget's state; only the last one pushed is
+    # made, and set or update also drop the appends queued before them
+    last_wins = frozenset(['set', 'update', 'change_status', 'set_focus', 'setTitle'])
+    resets = frozenset(['set', 'update'])
+    # Appends: extend calls are merged into one, add calls are kept
+    concatenated = frozenset(['extend'])
+    repeated = frozenset(['add'])
+
+    def __init__(self, loop, interval=1 / 30.0):
+        # Any thread may push; the calls are made on the main loop, at
+        # most once per interval, in the order widgets were first pushed
+        self.loop = loop
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._woken = False
+        self._alarm = None
+        self._applied_at = 0
+        self._pipe = loop.watch_pipe(self._wake)
+
+    def push(self, widget, method, *args):
+        with self._lock:
+            entry = self._pending.get(id(widget))
+            if entry is None:
+                entry = self._pending[id(widget)] = (widget, [])
+            ops = entry[1]
+            last = ops[-1] if ops else None
+
+            if method in self.last_wins:
+                dropped = self.resets | self.concatenated | self.repeated \
+                    if method in self.resets else ()
+                ops[:] = [
+                    op for op in ops
+                    if op[0] != method and op[0] not in dropped
+                ]
+                ops.append((method, [args]))
+            elif method in self.concatenated and last is not None and last[0] == method:
+                last[1][0][0].extend(args[0])
+            elif method in self.concatenated:
+                ops.append((method, [(list(args[0]),) + args[1:]]))
+            elif method in self.repeated and last is not None and last[0] == method:
+                last[1].append(args)
+            else:
+                ops.append((method, [args]))
+
+            wake = not self._woken
+            self._woken = True
+        if wake:
+            os.write(self._pipe, 'x')
+
+    def _wake(self, data):
+        if self._alarm is None:
+            delay = max(self._applied_at + self.interval - time.time(), 0.001)
+            self._alarm = self.loop.set_alarm_in(delay, self.flush)
+        return True
+
+    def flush(self, loop=None, user_data=None):
+        # Main loop only
+        self._alarm = None
+        with self._lock:
+            pending, self._pending = self._pending, collections.OrderedDict()
+            self._woken = False
+        self._applied_at = time.time()
+        for widget, ops in pending.values():
+            for method, calls in ops:
+                for args in calls:
+                    getattr(widget, method)(*args)
+
+    def close(self):
+        if self._alarm is not None:
+            self.loop.remove_alarm(self._alarm)
+            self._alarm = None
+        self.loop.remove_watch_pipe(self._pipe)
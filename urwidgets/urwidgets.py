@@ -1,10 +1,22 @@
 #!/usr/bin/python2
+import os
 import sys
+import bisect
+import threading
+import collections
+import Queue
+import contextlib
 import itertools
 import functools
+import difflib
 import shlex
+import types
 import urwid
 import utility
+import keymaps
+from keymaps import Keymap, counted
+from runner import CommandRunner, UpdateChannel, in_thread, in_process
+from collections import OrderedDict
 from functools import partial
 
 
@@ -26,18 +38,164 @@ def shift_iterable(iterable, offset, direction):
         return itertools.islice(
             itertools.cycle(reversed(iterable)), new_offset, new_offset + len(iterable)
         )
-    
+
+def shift_range(length, offset, direction):
+    # Same ordering as shift_iterable, but over positions so that nothing
+    # has to be copied out of the list being searched
+    if length == 0:
+        return iter(())
+    offset %= length
+    if direction == 'forward':
+        return itertools.chain(
+            xrange(offset, length), xrange(0, offset)
+        )
+    else:
+        return itertools.chain(
+            xrange(offset, -1, -1), xrange(length - 1, offset, -1)
+        )
+
+
+def keyed_diff(old, new, key):
+    # difflib opcodes turning old into new, with items compared by key
+    old_keys = [key(item) for item in old]
+    new_keys = [key(item) for item in new]
+    matcher = difflib.SequenceMatcher(None, old_keys, new_keys, autojunk=False)
+    return old_keys, new_keys, matcher.get_opcodes()
+
+def moved_items(opcodes, old_keys, new_keys):
+    # {new position: old position} for items removed in one place and
+    # inserted with the same key in another
+    removed = {}
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag in ('replace', 'delete'):
+            for index in xrange(i1, i2):
+                removed.setdefault(old_keys[index], index)
+    moved = {}
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag in ('replace', 'insert'):
+            for index in xrange(j1, j2):
+                if new_keys[index] in removed:
+                    moved[index] = removed.pop(new_keys[index])
+    return moved
+
+def kept_positions(opcodes, moved):
+    # {old position: new position} for every item that is kept, moved
+    # or not
+    kept = dict((old, new) for new, old in moved.items())
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            kept.update(zip(xrange(i1, i2), xrange(j1, j2)))
+    return kept
+
+def updated_position(opcodes, moved, position, length):
+    # Where the item at position ends up; if it was removed, wherever
+    # what followed it ended up
+    for tag, i1, i2, j1, j2 in opcodes:
+        if i1 <= position < i2:
+            if tag == 'equal':
+                return j1 + position - i1
+            for new, old in moved.items():
+                if old == position:
+                    return new
+            return max(min(j1, length - 1), 0)
+    return max(min(position, length - 1), 0)
+
+
+FILTER_CACHE_SIZE = 32
+SOURCE_CACHE_SIZE = 16
+SORT_KEY_CACHE_SIZE = 4
+
+# Kept in place of the sort keys of rows added while another key was in use
+_UNKNOWN_KEY = object()
+
+
+class SequenceWalker(urwid.ListWalker):
+    # Positions are 0 to len(self) - 1
+    def set_focus(self, position):
+        if position < 0 or position >= len(self):
+            raise IndexError(position)
+        self.focus = position
+
+    def next_position(self, position):
+        if len(self) - 1 <= position:
+            raise IndexError
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError
+        return position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return xrange(len(self) - 1, -1, -1)
+        return xrange(len(self))
+
+
+class VirtualWalker(SequenceWalker):
+    def __init__(self, source, factory, cache_size=256):
+        self.source = source
+        self.factory = factory
+        self.cache_size = cache_size
+        self.focus = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.source)
+
+    def __getitem__(self, position):
+        if position < 0 or position >= len(self.source):
+            raise IndexError(position)
+        # Widgets are cached by row rather than position, so they are
+        # still found after a RingBuffer source drops rows off the front
+        row = position + getattr(self.source, 'evicted', 0)
+        try:
+            widget = self._cache.pop(row)
+        except KeyError:
+            widget = self.factory(self.source[position])
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[row] = widget
+        return widget
+
+    def set_source(self, source):
+        self.source = source
+        self._cache.clear()
+        self.focus = max(0, min(self.focus, len(source) - 1))
+        self._modified()
+
+
+class FilterWalker(SequenceWalker):
+    # Shows the rows of body at indices, in order, without copying them
+    def __init__(self, body, indices):
+        self.body = body
+        self.indices = indices
+        self.focus = 0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, position):
+        if position < 0 or position >= len(self.indices):
+            raise IndexError(position)
+        return self.body[self.indices[position]]
+
+    def set_indices(self, indices, focus=0):
+        self.indices = indices
+        self.focus = focus
+        self._modified()
+
+
 class MappedEdit(urwid.Edit):
     def __init__(self, keymap={}, disabled=False,
                  *args, **kwargs):
 
         self.disabled = disabled
-        self.keymap = dict(keymap)
+        self.keymap = utility.own_keymap(keymap)
         super(MappedEdit, self).__init__(*args, **kwargs)
 
     def keypress(self, size, key):
-        if key in self.keymap:
-            key = self.keymap[key]()
+        handled, key = keymaps.dispatch(self, self.keymap, key)
         if key and not self.disabled:
             super(MappedEdit, self).keypress(size, key)
         return key
@@ -47,20 +205,37 @@ class MappedEdit(urwid.Edit):
 
 
 class MappedWrap(urwid.AttrMap):
+    # AttrMap state lives on the wrapper itself; everything else set on a
+    # MappedWrap, signal handlers included, is passed to the widget
+    _own_attributes = frozenset(['_original_widget', '_attr_map', '_focus_map'])
+    _wrapped_classes = set()
+    _wrapped_signals = set()
+
+    _no_keymap = utility.FrozenKeymap()
+
+    # Canvases are held for the focused row and the row it just left
+    held_rows = 2
+    _held = OrderedDict()
+
     def __init__(self, widget,
                  attrmap=None, focusmap=None,
                  keymap={}, selectable=True,
                  *args, **kwargs):
         
         cls = widget.__class__
-        signals = urwid.signals._signals._supported[cls]
-        for signal in signals:
-            urwid.register_signal(MappedWrap, signal)
+        if cls not in MappedWrap._wrapped_classes:
+            MappedWrap._wrapped_classes.add(cls)
+            MappedWrap._wrapped_signals.update(
+                urwid.signals._signals._supported.get(cls, ())
+            )
+            urwid.register_signal(MappedWrap, list(MappedWrap._wrapped_signals))
 
 
         self.__dict__['_widget'] = widget
-        self.__dict__['keymap'] = dict(keymap)
+        self.__dict__['_keymap'] = utility.own_keymap(keymap) \
+            if keymap else MappedWrap._no_keymap
         self.__dict__['_s'] = selectable
+        self.__dict__['_keys'] = hasattr(widget, 'keypress')
 
         super(MappedWrap, self).__init__(widget, attrmap, focusmap, *args, **kwargs)
 
@@ -68,18 +243,71 @@ class MappedWrap(urwid.AttrMap):
         return getattr(self._widget, name)
 
     def __setattr__(self, name, value):
-        if hasattr(MappedWrap, name):
-            return getattr(MappedWrap, name).fset(self, value)
+        if name in self._own_attributes:
+            self.__dict__[name] = value
+            return
+        attribute = getattr(type(self), name, None)
+        if isinstance(attribute, property):
+            return attribute.fset(self, value)
         else:
             return setattr(self._widget, name, value)
 
     def keypress(self, size, key):
-        if hasattr(self._widget, 'keypress'):
+        if self._keys:
             key = super(MappedWrap, self).keypress(size, key)
-        if key in self.keymap:
-            key = self.keymap[key]()
+        handled, key = keymaps.dispatch(self, self._keymap, key)
         return key
 
+    def render(self, size, focus=False):
+        # urwid only keeps canvases while something else refers to them,
+        # so both canvases of the last few focused rows are held here.
+        # Moving focus back and forth then finds them in the cache instead
+        # of rendering the widget again.
+        canvas = super(MappedWrap, self).render(size, focus)
+        MappedWrap._release_stale()
+        held = MappedWrap._held
+        focus = bool(focus)
+        if focus:
+            canvases = held.pop(self, None)
+            if canvases is None:
+                # Still alive if the screen holds the previous frame
+                canvases = {}
+                unfocused = urwid.CanvasCache.fetch(self, urwid.AttrMap, size, False)
+                if unfocused is not None:
+                    canvases[False] = (size, unfocused)
+            held[self] = canvases
+            while len(held) > self.held_rows:
+                held.popitem(last=False)
+        if self in held:
+            held[self][focus] = (size, canvas)
+        return canvas
+
+    @staticmethod
+    def _release_stale():
+        # The cache drops the canvases AttrMap rendered once the widget
+        # changes, even one nested deeper than the wrapped widget; holding
+        # them past that is a leak
+        for wrap, canvases in MappedWrap._held.items():
+            for focus, (size, canvas) in canvases.items():
+                if urwid.CanvasCache.fetch(wrap, urwid.AttrMap, size, focus) is not canvas:
+                    del canvases[focus]
+
+    def _invalidate(self):
+        MappedWrap._held.pop(self, None)
+        super(MappedWrap, self)._invalidate()
+
+    @property
+    def keymap(self):
+        # Rows built without a keymap share an empty one until somebody
+        # asks for theirs
+        if self._keymap is MappedWrap._no_keymap:
+            self.__dict__['_keymap'] = {}
+        return self._keymap
+
+    @keymap.setter
+    def keymap(self, value):
+        self.__dict__['_keymap'] = utility.own_keymap(value)
+
     def selectable(self):
         return self._s
 
@@ -109,10 +337,25 @@ class MappedWrap(urwid.AttrMap):
         return self._widget
 
 
+class CommandError(ValueError):
+    pass
+
+
+class Batch(list):
+    # Commands already parsed and checked, as (name, command, args)
+    pass
+
+
 class CommandFrameController(object):
-    def __init__(self, command_frame, commands):
+    def __init__(self, command_frame, commands, runner=None):
         self._frame = command_frame
         self._commands = dict(commands)
+        self.runner = runner
+        self.macros = {}
+        self._recording = None
+        self._completion_source = None
+        self._completion_index = None
+        self._sources = OrderedDict()
 
     def areyousure(self, yes, no):
         def no_func():
@@ -124,24 +367,145 @@ class CommandFrameController(object):
             self._frame.escape()
 
         return (yes_func, no_func)
+
+    def completion_index(self, completion_set):
+        # Reused while the same tuple or frozenset keeps being passed in.
+        # Anything that can change in place is indexed again every time;
+        # pass a CompletionIndex to keep one over a large mutable set.
+        if isinstance(completion_set, (utility.CompletionIndex, utility.FuzzyIndex)):
+            return completion_set
+        if not isinstance(completion_set, (tuple, frozenset)):
+            return utility.CompletionIndex(completion_set)
+        if completion_set is not self._completion_source:
+            self._completion_index = utility.CompletionIndex(completion_set)
+            self._completion_source = completion_set
+        return self._completion_index
+
+    def completion_source(self, source):
+        # Kept for the most recently used sources only, since a new
+        # callable may be passed in for every prompt
+        if isinstance(source, utility.CompletionSource):
+            return source
+        wrapped = self._sources.pop(source, None)
+        if wrapped is None:
+            wrapped = utility.CompletionSource(source)
+        self._sources[source] = wrapped
+        if len(self._sources) > SOURCE_CACHE_SIZE:
+            self._sources.popitem(last=False)
+        return wrapped
+
+    def _lazy(self, source):
+        return callable(source) or isinstance(
+            source, (utility.CompletionSource, types.GeneratorType)
+        )
+
+    def complete(self, completion_set, text):
+        # Eager completion sets complete the whole line. Lazy sources
+        # (callables, generators or a {argument position: source} dict)
+        # complete the last word, using whatever has been loaded so far.
+        if not (isinstance(completion_set, dict) or self._lazy(completion_set)):
+            return self.completion_index(completion_set).complete(text)
+
+        # Arguments are split as parse_command will split them; inside an
+        # open quote there's no telling, so they are split on whitespace
+        head, separator, word = text.rpartition(' ')
+        try:
+            args = tuple(shlex.split(head))
+        except ValueError:
+            args = tuple(head.split())
+        if isinstance(completion_set, dict):
+            if len(args) not in completion_set:
+                return (text, tuple())
+            source = completion_set[len(args)]
+        else:
+            source = completion_set
+
+        if self._lazy(source):
+            index = self.completion_source(source).index(*args)
+        else:
+            index = self.completion_index(source)
+        prefix = head + separator
+        word, hits = index.complete(word)
+        return (prefix + word, tuple(prefix + hit for hit in hits))
             
+    def parse_command(self, data):
+        try:
+            parse_result = shlex.split(data)
+        except ValueError:
+            raise CommandError("Invalid command")
+        func = parse_result[0]
+        args = parse_result[1:]
+        if func not in self._commands:
+            raise CommandError("Command not found")
+        command = self._commands[func]
+        try:
+            utility.check_arguments(command, len(args))
+        except TypeError:
+            raise CommandError("Wrong number of arguments")
+        return (func, command, args)
+
+    def _dispatch(self, func, command, args):
+        try:   
+            if self.runner is not None and self.runner.accepts(command):
+                self.runner.submit(func, command, args)
+            else:
+                command(*args)
+        except TypeError:
+            # Too many arguments
+            self._frame.change_status("Wrong number of arguments")
+
     def submit_command(self, data):
         if data.strip():
             try:
-                parse_result = shlex.split(data)
-            except ValueError:
-                self._frame.change_status("Invalid command")
+                parsed = self.parse_command(data)
+            except CommandError as error:
+                self._frame.change_status(str(error))
             else:
-                func = parse_result[0]
-                args = parse_result[1:]
-                if func not in self._commands:
-                    self._frame.change_status("Command not found")
-                else:
-                    try:   
-                        self._commands[func](*args)
-                    except TypeError:
-                        # Too many arguments
-                        self._frame.change_status("Wrong number of arguments")
+                if self._recording is not None:
+                    self._recording.append(parsed)
+                self._dispatch(*parsed)
+
+    def compile_batch(self, script):
+        # script is a multi-line string or an iterable of command lines;
+        # blank lines and lines starting with '#' are skipped
+        if isinstance(script, basestring):
+            script = script.splitlines()
+        batch = Batch()
+        for number, line in enumerate(script, 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                batch.append(self.parse_command(line))
+            except CommandError as error:
+                raise CommandError("Line %d: %s" % (number, error))
+        return batch
+
+    def run_batch(self, script):
+        # Nothing runs unless every command in the script is valid
+        if not isinstance(script, Batch):
+            try:
+                script = self.compile_batch(script)
+            except CommandError as error:
+                self._frame.change_status(str(error))
+                return False
+        for parsed in script:
+            self._dispatch(*parsed)
+        return True
+
+    def run_script(self, path):
+        with open(path) as script:
+            return self.run_batch(script.read())
+
+    def start_recording(self):
+        self._recording = Batch()
+
+    def stop_recording(self, name):
+        self.macros[name] = self._recording
+        self._recording = None
+        return self.macros[name]
+
+    def run_macro(self, name):
+        return self.run_batch(self.macros[name])
 
     def start_editing(self, callback, completion_set):
         callback = callback or self.submit_command
@@ -151,14 +515,17 @@ class CommandFrameController(object):
             tab_through.clear()
 
         def complete():
+            # Hits are looked up again on every press so that results from
+            # a source still loading in the background show up as they arrive
             if not tab_through:
-                text, hits = utility.complete(
-                    completion_set,
-                    self._frame.command_line_text
-                )
-                tab_through[text] = itertools.cycle(hits)
+                tab_through['text'] = self._frame.command_line_text
+                tab_through['count'] = 0
+                text, hits = self.complete(completion_set, tab_through['text'])
             else:
-                text = tab_through.values()[0].next()
+                text, hits = self.complete(completion_set, tab_through['text'])
+                if hits:
+                    text = hits[tab_through['count'] % len(hits)]
+                    tab_through['count'] += 1
 
             self._frame.command_line_text = text
             self._frame.command_line_position = len(self._frame.command_line_text)
@@ -179,6 +546,8 @@ class CommandFrameController(object):
 class CommandFrame(urwid.Frame):
     def __init__(self, body, header=None, focus_part='body', commands={}):
         self.__controller = CommandFrameController(self, commands)
+        self._suspended = 0
+        self._pending_status = None
 
         if not hasattr(self, 'keymap'):
             self.keymap = {}
@@ -187,15 +556,23 @@ class CommandFrame(urwid.Frame):
         self.command_line = MappedWrap(command_line)
 
 
-        self.keymap[':'] = functools.partial(self.start_editing, callback=self.submit_command)
+        bindings = {
+            ':': functools.partial(self.start_editing, callback=self.submit_command),
+        }
+        if 'esc' not in self.keymap:
+            # A subclass may have bound esc itself
+            bindings['esc'] = self.cancel_commands
+        if isinstance(self.keymap, Keymap):
+            self.keymap = self.keymap.extend(bindings)
+        else:
+            self.keymap.update(bindings)
 
 
         super(CommandFrame, self).__init__(body, header, self.command_line, focus_part)
 
     def keypress(self, size, key):
         key = urwid.Frame.keypress(self, size, key)
-        if key in self.keymap:
-            self.keymap[key]()
+        keymaps.dispatch(self, self.keymap, key)
         return key
 
     def escape(self):
@@ -226,6 +603,52 @@ class CommandFrame(urwid.Frame):
     def submit_command(self, data):
         self.__controller.submit_command(data)
 
+    @contextlib.contextmanager
+    def suspended(self):
+        # Status changes made inside are held back and only the last one
+        # is shown when the outermost block exits
+        self._suspended += 1
+        try:
+            yield
+        finally:
+            self._suspended -= 1
+            if not self._suspended and self._pending_status is not None:
+                stat, self._pending_status = self._pending_status, None
+                self.change_status(stat)
+
+    def run_batch(self, script):
+        with self.suspended():
+            return self.__controller.run_batch(script)
+
+    def run_script(self, path):
+        with self.suspended():
+            return self.__controller.run_script(path)
+
+    def run_macro(self, name):
+        with self.suspended():
+            return self.__controller.run_macro(name)
+
+    def set_loop(self, loop, max_workers=4):
+        # Commands marked with in_thread/in_process and generator commands
+        # run in the background on this loop; others still run inline
+        self.__controller.runner = CommandRunner(
+            loop, self.report_status, max_workers
+        )
+
+    def cancel_commands(self):
+        if self.__controller.runner is not None:
+            self.__controller.runner.cancel()
+
+    def report_status(self, stat):
+        # Don't throw away a command that is being typed
+        if self.footer is not self.command_line \
+                or self.focus_position != 'footer':
+            self.change_status(stat)
+
+    @property
+    def controller(self):
+        return self.__controller
+
     def stop_editing(self):
         self.command_line.set_caption('')
         self.command_line.set_edit_text('')
@@ -251,6 +674,9 @@ class CommandFrame(urwid.Frame):
         self.command_line.keymap['backspace'] = backspace
         
     def change_status(self, stat):
+        if self._suspended:
+            self._pending_status = stat
+            return
         self.footer = urwid.Text(stat)
 
     @property
@@ -271,29 +697,169 @@ class CommandFrame(urwid.Frame):
 
 
 class MappedList(urwid.ListBox):
-    def __init__(self, body, keymap={}):
-        self.scroll = utility.scroll(range(len(body))) \
-            if len(body) != 0 else utility.scroll([0])
-        self.keymap = dict(keymap)
+    # How selected rows are drawn: an attribute, or a mapping of
+    # attributes, as AttrMap takes them
+    selected_attr = 'selected'
+    selected_focus_attr = None
+
+    def __init__(self, body, keymap={}, factory=None, index_key=None,
+                 coalesce=False, follow=False, sort_key=None, loop=None):
+        # With a factory, body is a sized, indexable source of rows and
+        # widgets are only built for the rows the ListBox asks for
+        if factory is not None:
+            body = VirtualWalker(body, factory)
+        self.scroll = utility.Cursor(len(body))
+        self.keymap = utility.own_keymap(keymap)
 
         self.search_anchor = None
 
-        self._searcher = search
-        self._builder = shift_iterable
+        self._query = None
+        self._direction = 'forward'
+        self.search_index = None
+
+        # When coalescing, 'shift' is emitted once, from an alarm the loop
+        # runs before it redraws, however many moves were made in between.
+        # Without a loop, pending moves wait for flush().
+        self.coalesce = coalesce
+        self.loop = loop
+        self._shift_pending = False
+
+        # When extended, focus on the last row moves on to the new last row
+        self.follow = follow
+
+        # Set while filtered: the view shown in place of the body, the
+        # body itself, and the index lists of recent queries
+        self._filter = None
+        self._unfiltered = None
+        self._filter_query = None
+        self._filter_args = None
+        self._filter_cache = OrderedDict()
+        self._extending = False
+
+        # (key, FuzzyIndex) over the rows shown, dropped when they change
+        self._fuzzy = None
+
+        # Marks by position in the body, kept in step with its rows
+        self.selection = utility.Selection(len(body))
+        self._styling = False
+
+        # In sorted mode, the key rows are kept in order of, and the keys
+        # worked out so far by key function, in the order of the rows
+        self._sort_key = None
+        self._sort_keys = OrderedDict()
+        self._reordering = False
 
         super(MappedList, self).__init__(body)
+        try:
+            urwid.connect_signal(self.body, 'modified', self._rows_changed)
+        except NameError:
+            pass
+        if hasattr(self.body, 'set_validate_contents_modified'):
+            self.body.set_validate_contents_modified(self._rows_modified)
+
+        if index_key is not None:
+            self.set_search_index(index_key)
+        if sort_key is not None:
+            self.sort(sort_key)
 
     def keypress(self, size, key):
-        if key not in ('up', 'down'):
+        if key not in ('up', 'down', 'page up', 'page down'):
             key = super(MappedList, self).keypress(size, key)
-        if key in self.keymap:
-            key = self.keymap[key]()
+        handled, key = keymaps.dispatch(self, self.keymap, key)
+        if handled:
+            pass
         elif key == 'up':
             self.shiftUp()
         elif key == 'down':
             self.shiftDown()
+        elif key == 'page up':
+            self.shiftUp(max(size[1] - 1, 1))
+        elif key == 'page down':
+            self.shiftDown(max(size[1] - 1, 1))
         return key
 
+    def render(self, size, focus=False):
+        self._styling = self.selection.any()
+        try:
+            return super(MappedList, self).render(size, focus)
+        finally:
+            self._styling = False
+
+    def calculate_visible(self, size, focus=False):
+        # While rendering, selected rows are drawn through selected_attr
+        # rather than by changing the rows themselves
+        middle, top, bottom = super(MappedList, self).calculate_visible(size, focus)
+        if not self._styling or middle is None:
+            return middle, top, bottom
+        offset, widget, position, rows, cursor = middle
+        return (
+            (offset, self._styled(widget, position), position, rows, cursor),
+            (top[0], [(self._styled(w, p), p, r) for w, p, r in top[1]]),
+            (bottom[0], [(self._styled(w, p), p, r) for w, p, r in bottom[1]]),
+        )
+
+    def _styled(self, widget, position):
+        if self.original_position(position) in self.selection:
+            return urwid.AttrMap(widget, self.selected_attr, self.selected_focus_attr)
+        return widget
+
+    def _shifted(self):
+        if not self.coalesce:
+            urwid.emit_signal(self, 'shift')
+        elif not self._shift_pending:
+            self._shift_pending = True
+            if self.loop is not None:
+                self.loop.set_alarm_in(0, lambda loop, data: self.flush())
+
+    def flush(self):
+        if self._shift_pending:
+            self._shift_pending = False
+            urwid.emit_signal(self, 'shift')
+
+    @property
+    def unfiltered(self):
+        return self._unfiltered if self._filter is not None else self.body
+
+    @property
+    def filtered(self):
+        return self._filter is not None
+
+    @property
+    def virtual(self):
+        return isinstance(self.unfiltered, VirtualWalker)
+
+    def _rows(self):
+        # What search predicates are run against: the source rows in
+        # virtual mode, the widgets otherwise
+        body = self.unfiltered
+        return body.source if self.virtual else body
+
+    def _tracked(self):
+        # Whether changes to the rows can be followed: through our own
+        # methods in virtual mode, or a walker that reports what changed
+        # before it changes, as SimpleFocusListWalker does. Others, like
+        # SimpleListWalker, only say that something changed.
+        return self.virtual \
+            or hasattr(self.unfiltered, 'set_validate_contents_modified')
+
+    def set_search_index(self, key):
+        # Searches made without an explicit key run against a column of
+        # key(row) values that is kept in step with the body
+        if not self._tracked():
+            raise ValueError("A search index needs a body that reports "
+                             "its changes, such as SimpleFocusListWalker")
+        self.search_index = utility.SearchIndex(self._rows(), key)
+        if not self.virtual:
+            self.unfiltered.set_validate_contents_modified(self._rows_modified)
+
+    def _rows_modified(self, indices, new_items):
+        if self._reordering:
+            return
+        start, stop, step = indices
+        self.selection.replace(start, stop, len(new_items), step)
+        if self.search_index is not None:
+            self.search_index.replace(start, stop, new_items, step)
+
     def top(self):
         self.set_focus(0)
 
@@ -301,192 +867,1034 @@ class MappedList(urwid.ListBox):
         self.set_focus(len(self.body) - 1)
 
     def shiftDown(self, amount=1):
-        if self.body.focus is not self.scroll(amount):
+        if self.body.focus != self.scroll(amount):
             self.focus_position = self.scroll()
-            self.body[:] = self.body[:]
-            urwid.emit_signal(self, 'shift')
+            self._invalidate()
+            self._shifted()
         else:
             urwid.emit_signal(self, 'bottom')
 
     def shiftUp(self, amount=1):
-        if self.body.focus is not self.scroll(-amount):
+        if self.body.focus != self.scroll(-amount):
             self.focus_position = self.scroll()
-            self.body[:] = self.body[:]
-            urwid.emit_signal(self, 'shift')
+            self._invalidate()
+            self._shifted()
         else:
             urwid.emit_signal(self,'top')
 
     def set(self, contents):
-        self.body[:] = contents
+        # While filtered the body is replaced underneath the filter, which
+        # is then run again over the new contents
+        if self._sort_key is not None:
+            contents = self._sorted(contents)
+        if self.virtual:
+            if self.search_index is not None:
+                self.search_index.rebuild(contents)
+            self.selection.reset(len(contents))
+            self.unfiltered.set_source(contents)
+        else:
+            self.unfiltered[:] = contents
+        if self.filtered:
+            return
         currentIndex = self.scroll()
         focusIndex = len(contents) - 1 \
             if len(contents) < currentIndex \
             else currentIndex
-        self.scroll = utility.scroll(range(len(contents)), focusIndex)
+        self.scroll.reset(len(contents), focusIndex)
+
+    def update(self, contents, key=(lambda x: x)):
+        # Like set, but only inserts and removes what difflib finds has
+        # changed, matching rows up by key(row). Rows with an unchanged key
+        # keep their widget, moved ones included, so their canvases stay
+        # cached, and focus stays on the row with the same key if it is
+        # still there without scrolling the view.
+        contents = list(contents)
+        if self._sort_key is not None:
+            contents = self._sorted(contents)
+        body = self.unfiltered
+        old = list(self._rows())
+        old_keys, new_keys, opcodes = keyed_diff(old, contents, key)
+        moved = moved_items(opcodes, old_keys, new_keys)
+        focus = updated_position(opcodes, moved, body.focus, len(contents))
+        kept = kept_positions(opcodes, moved)
+        marks = [kept[index] for index in self.selection if index in kept]
+
+        if self.virtual:
+            self._update_source(old, contents, opcodes, moved)
+            body.focus = focus
+            body._modified()
+        else:
+            for tag, i1, i2, j1, j2 in reversed(opcodes):
+                if tag != 'equal':
+                    body[i1:i2] = [
+                        old[moved[index]] if index in moved else contents[index]
+                        for index in xrange(j1, j2)
+                    ]
+            if contents:
+                body.set_focus(focus)
+        self.selection.reset(len(contents))
+        self.selection.update(marks)
+
+        if not self.filtered:
+            self.scroll.reset(len(contents), focus)
+            self._invalidate()
+
+    def _update_source(self, old, contents, opcodes, moved):
+        # Rows under an unchanged key may still differ; those get a new
+        # widget and search key like any other changed row
+        walker = self.unfiltered
+        changed = []
+        kept = {}
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                for offset in xrange(i2 - i1):
+                    if old[i1 + offset] == contents[j1 + offset]:
+                        kept[i1 + offset] = j1 + offset
+                    else:
+                        changed.append((i1 + offset, j1 + offset))
+        for new, index in moved.items():
+            if old[index] == contents[new]:
+                kept[index] = new
+
+        if self.search_index is not None:
+            for index, new in changed:
+                self.search_index.replace(index, index + 1, [contents[new]])
+            for tag, i1, i2, j1, j2 in reversed(opcodes):
+                if tag != 'equal':
+                    self.search_index.replace(i1, i2, contents[j1:j2])
+
+        evicted = getattr(walker.source, 'evicted', 0)
+        cache = OrderedDict()
+        for row, widget in walker._cache.items():
+            new = kept.get(row - evicted)
+            if new is not None:
+                cache[new] = widget
+        walker.source = contents
+        walker._cache = cache
+
+    def extend(self, rows):
+        # Appends rows (source rows in virtual mode, widgets otherwise)
+        # without rebuilding the body. A RingBuffer source drops its
+        # oldest rows past max_rows, and focus stays on the row it was on,
+        # or the first one left if that row was dropped.
+        rows = list(rows)
+        if not rows:
+            return
+        if self._sort_key is not None:
+            self._insert_sorted(rows)
+            return
+        body = self.unfiltered
+        focus = body.focus
+        at_tail = self.follow and focus >= len(body) - 1
+        length = len(body)
+        evicted = 0
+
+        # A filter is brought up to date with the new rows alone below,
+        # rather than by running it over the whole body again
+        self._extending = True
+        try:
+            if self.virtual:
+                source = body.source
+                evicted = source.extend(rows) or 0
+                self.selection.replace(length, length, len(rows))
+                if evicted:
+                    self.selection.replace(0, evicted, 0)
+                if self.search_index is not None:
+                    self.search_index.replace(length, length, rows)
+                    if evicted:
+                        self.search_index.replace(0, evicted, [])
+                body.focus = len(body) - 1 if at_tail else max(focus - evicted, 0)
+                body._modified()
+            else:
+                body.extend(rows)
+                if at_tail:
+                    body.set_focus(len(body) - 1)
+        finally:
+            self._extending = False
+
+        if self.filtered:
+            self._extend_filter(length - evicted, evicted)
+        else:
+            self.scroll.reset(len(body), body.focus)
+            if at_tail:
+                self.set_focus_valign('bottom')
+                self._shifted()
+            self._invalidate()
+
+    def stream(self, source, loop, **kwargs):
+        return RowStream(self, source, loop, **kwargs)
+
+    @property
+    def sort_key(self):
+        return self._sort_key
+
+    def sort(self, key):
+        # Keeps the rows in order of key(row) from now on, focus staying on
+        # the same row. Each row's key is worked out once and kept, so
+        # going back to a key used before doesn't call it again, and rows
+        # added with extend or add are put in place by bisection. In
+        # sorted mode, change the rows through the list rather than the
+        # body, or the kept keys go out of step. Keys are kept for the
+        # last SORT_KEY_CACHE_SIZE key functions.
+        rows = self._rows()
+        if getattr(rows, 'max_rows', None) is not None:
+            raise ValueError("A source with max_rows can't be kept sorted, "
+                             "since its oldest rows are the ones dropped")
+        if self.virtual and not isinstance(rows, list):
+            # Rows are inserted into the source, so it needs to be a list
+            rows = list(rows)
+            self.unfiltered.set_source(rows)
+        keys = self._sort_keys.pop(key, None)
+        if keys is None or len(keys) != len(rows):
+            keys = [key(row) for row in rows]
+        else:
+            for index, value in enumerate(keys):
+                if value is _UNKNOWN_KEY:
+                    keys[index] = key(rows[index])
+        self._sort_keys[key] = keys
+        while len(self._sort_keys) > SORT_KEY_CACHE_SIZE:
+            self._sort_keys.popitem(last=False)
+        self._sort_key = key
+        self._reorder(sorted(xrange(len(keys)), key=keys.__getitem__))
+
+    def unsort(self):
+        # Rows stay as they are, and new ones are appended again
+        self._sort_key = None
+        self._sort_keys.clear()
+
+    def _sorted(self, contents):
+        key = self._sort_key
+        keys = [key(row) for row in contents]
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        self._sort_keys = OrderedDict([(key, map(keys.__getitem__, order))])
+        return map(contents.__getitem__, order)
+
+    def _reorder(self, order):
+        # Position n gets the row that was at order[n]
+        focus = self.original_position()
+        body = self.unfiltered
+        moved_to = [0] * len(order)
+        for position, index in enumerate(order):
+            moved_to[index] = position
+
+        for key, keys in self._sort_keys.items():
+            self._sort_keys[key] = map(keys.__getitem__, order)
+        self.selection.permute(order)
+        if self.search_index is not None:
+            self.search_index.permute(order)
+
+        if self.virtual:
+            body._cache = OrderedDict(
+                (moved_to[row], widget) for row, widget in body._cache.items()
+            )
+            body.source = map(body.source.__getitem__, order)
+            body._modified()
+        else:
+            self._reordering = True
+            try:
+                body[:] = map(body.__getitem__, order)
+            finally:
+                self._reordering = False
+
+        if focus is not None and order:
+            self._refocus(moved_to[focus])
+
+    def _refocus(self, index):
+        # Focus the row at index in the body, if the view shows it
+        if self._filter is not None:
+            indices = self._filter.indices
+            position = bisect.bisect_left(indices, index)
+            if position >= len(indices) or indices[position] != index:
+                return
+            index = position
+        self.focus_position = index
+        self.scroll.reset(len(self.body), index)
+        self._invalidate()
+
+    def add(self, row):
+        # Returns the position the row was put at
+        if self._sort_key is not None:
+            return self._insert_sorted([row])
+        self.extend([row])
+        return len(self.unfiltered) - 1
+
+    def _insert_sorted(self, rows):
+        body = self.unfiltered
+        focus = self.original_position()
+        sort_keys = self._sort_keys
+        ordered = sort_keys[self._sort_key]
+        others = [keys for keys in sort_keys.values() if keys is not ordered]
+
+        for row in rows:
+            # Only the key in use; the others are worked out if sorted by
+            # them again
+            row_key = self._sort_key(row)
+            position = bisect.bisect_right(ordered, row_key)
+            ordered.insert(position, row_key)
+            for keys in others:
+                keys.insert(position, _UNKNOWN_KEY)
+            if focus is not None and position <= focus:
+                focus += 1
+
+            if self.virtual:
+                body.source.insert(position, row)
+                body._cache = OrderedDict(
+                    (cached + 1 if cached >= position else cached, widget)
+                    for cached, widget in body._cache.items()
+                )
+                self.selection.replace(position, position, 1)
+                if self.search_index is not None:
+                    self.search_index.replace(position, position, [row])
+            else:
+                body.insert(position, row)
+
+        if self.virtual:
+            body._modified()
+        if focus is None:
+            focus = 0
+        if self.filtered:
+            self._refocus(focus)
+        else:
+            body.set_focus(focus)
+            self.scroll.reset(len(body), focus)
+            self._invalidate()
+        return position
 
     def set_focus(self, position):
         self.focus_position = position
         self.set_focus_valign('middle')
-        self.body[:] = self.body[:]
-        self.scroll = utility.scroll(range(len(self.body[:])), position)
-        urwid.emit_signal(self, 'shift')
+        self._invalidate()
+        self.scroll.reset(len(self.body), position)
+        self._shifted()
+
+    def jump(self, percent):
+        if not self.isEmpty():
+            self.set_focus(int(round((len(self.body) - 1) * percent / 100.0)))
+
+    def _source_keyed(self, key):
+        # Rows of the whole body, by position in the body
+        if key is None and self.search_index is not None:
+            keys = self.search_index.keys
+            return keys, (lambda index: keys[index])
+        if key is None:
+            key = lambda x: x
+        rows = self._rows()
+        return rows, (lambda index: key(rows[index]))
+
+    def _keyed(self, key):
+        # Rows as currently shown, by position in the view
+        rows, row_key = self._source_keyed(key)
+        if self._filter is None:
+            return rows, row_key
+        indices = self._filter.indices
+        return indices, (lambda position: row_key(indices[position]))
+
+    def filter(self, query, match=(lambda query, row: query in row), key=None):
+        # Shows only the rows where match(query, key(row)), through an
+        # index mapping over the unchanged body; an empty query shows them
+        # all again. A row matching a query is assumed to match every
+        # prefix of it, so an extended query only re-checks what matched
+        # before, and recent results are kept for when it is shortened.
+        if not query:
+            self.unfilter()
+            return
+        if self._filter_args != (match, key):
+            self._filter_cache.clear()
+            self._filter_args = (match, key)
+
+        indices = self._filter_cache.pop(query, None)
+        if indices is None:
+            indices = self._narrow(query)
+        self._filter_cache[query] = indices
+        if len(self._filter_cache) > FILTER_CACHE_SIZE:
+            self._filter_cache.popitem(last=False)
+        self._show(query, indices)
+
+    def _narrow(self, query):
+        match, key = self._filter_args
+        rows, row_key = self._source_keyed(key)
+        candidates = None
+        for length in xrange(len(query) - 1, 0, -1):
+            candidates = self._filter_cache.get(query[:length])
+            if candidates is not None:
+                break
+        if candidates is None:
+            candidates = xrange(len(rows))
+        return [index for index in candidates if match(query, row_key(index))]
+
+    def _show(self, query, indices):
+        # Focus stays on the same row if it's still shown, otherwise on
+        # the nearest one after it
+        anchor = self.original_position()
+        if self._filter is None:
+            self._unfiltered = self.body
+            self._filter = FilterWalker(self.body, indices)
+            urwid.connect_signal(self._filter, 'modified', self._invalidate)
+            urwid.connect_signal(self._filter, 'modified', self._rows_changed)
+            urwid.connect_signal(self._unfiltered, 'modified', self._refilter)
+            self.body = self._filter
+            self._rows_changed()
+        else:
+            self._filter.set_indices(indices)
+        self._filter_query = query
+
+        position = 0
+        if anchor is not None:
+            position = min(bisect.bisect_left(indices, anchor), max(len(indices) - 1, 0))
+        self._filter.focus = position
+        self.scroll.reset(len(indices), position)
+        self._invalidate()
+        self._shifted()
+
+    def _extend_filter(self, start, evicted):
+        # Rows from start on were appended to the body and evicted rows
+        # dropped off its front: every kept result loses the evicted rows
+        # and gains the new rows it matches
+        match, key = self._filter_args
+        rows, row_key = self._source_keyed(key)
+        dropped = bisect.bisect_left(self._filter.indices, evicted)
+        for query, indices in self._filter_cache.items():
+            if evicted:
+                indices = [index - evicted for index in
+                           indices[bisect.bisect_left(indices, evicted):]]
+            indices.extend(index for index in xrange(start, len(rows))
+                           if match(query, row_key(index)))
+            self._filter_cache[query] = indices
+
+        # Focus stays on the same row, or the first one left if that row
+        # was evicted
+        indices = self._filter_cache[self._filter_query]
+        position = max(self._filter.focus - dropped, 0)
+        self._filter.set_indices(indices, position)
+        self.scroll.reset(len(indices), position)
+        if dropped:
+            self._shifted()
+
+    def _refilter(self):
+        # The body changed underneath the filter
+        if self._extending:
+            return
+        query = self._filter_query
+        self._filter_cache.clear()
+        self._filter_cache[query] = indices = self._narrow(query)
+        self._show(query, indices)
+
+    def unfilter(self):
+        if self._filter is None:
+            return
+        position = self.original_position()
+        urwid.disconnect_signal(self._unfiltered, 'modified', self._refilter)
+        self.body = self._unfiltered
+        self._rows_changed()
+        self._filter = None
+        self._unfiltered = None
+        self._filter_query = None
+        self._filter_args = None
+        self._filter_cache.clear()
+        if position is None:
+            self.scroll.reset(len(self.body), self.scroll())
+            self._invalidate()
+        else:
+            self.set_focus(position)
+
+    def _rows_changed(self):
+        self._fuzzy = None
+
+    def _fuzzy_index(self, key):
+        if self._fuzzy is None or self._fuzzy[0] is not key:
+            rows, row_key = self._keyed(key)
+            self._fuzzy = (key, utility.FuzzyIndex(
+                row_key(position) for position in xrange(len(rows))
+            ))
+        return self._fuzzy[1]
+
+    def fuzzy_search(self, query, limit=None, key=None):
+        # Focuses the best fuzzy match for query and returns the positions
+        # of up to limit matches, best first; next and prev then step
+        # through every match in list order. key(row) must give text
+        # unless the rows (or the search index keys) already are.
+        index = self._fuzzy_index(key)
+        ranked = index.rank(query, limit)
+        matched = frozenset(index.items[position] for position in index.matches(query))
 
-    def inc_search(self, predicate, direction, key=(lambda x: x)):
+        self.search_anchor = None
+        self._query = (matched.__contains__, key)
+        self._direction = 'forward'
+        if ranked:
+            self.set_focus(ranked[0])
+        return ranked
+
+    def original_position(self, position=None):
+        # Position in the body of a row in the view (the focused one by
+        # default); None if the view is empty
+        if self._filter is None:
+            return self.body.focus if position is None else position
+        indices = self._filter.indices
+        position = self._filter.focus if position is None else position
+        return indices[position] if 0 <= position < len(indices) else None
+
+    def _selection(self):
+        # Marks are by position, so can't be kept on the right rows if
+        # the body doesn't say where it changed
+        if not self._tracked():
+            raise ValueError("Selecting rows needs a body that reports "
+                             "its changes, such as SimpleFocusListWalker")
+        return self.selection
+
+    def toggle_selection(self, position=None):
+        # Position in the view, the focused row by default
+        selection = self._selection()
+        position = self.original_position(position)
+        if position is not None:
+            selection.toggle(position)
+            self._invalidate()
+
+    def select_all(self):
+        # Every row shown, so only those matching while filtered
+        if self._filter is None:
+            self._selection().select_all()
+        else:
+            self._selection().update(self._filter.indices)
+        self._invalidate()
+
+    def select_none(self):
+        self.selection.clear()
+        self._invalidate()
+
+    def invert_selection(self):
+        if self._filter is None:
+            self._selection().invert()
+        else:
+            self._selection().toggle_all(self._filter.indices)
+        self._invalidate()
+
+    def select_matches(self, predicate, key=None):
+        # Adds the shown rows a search for predicate would stop on, and
+        # returns how many there were
+        selection = self._selection()
+        matched = self._matching(predicate, key)
+        selection.update(matched)
+        self._invalidate()
+        return len(matched)
+
+    def _matching(self, predicate, key):
+        rows = self._rows()
+        if key is None and self.search_index is None \
+                and isinstance(rows, utility.RowStore) \
+                and utility.is_pattern(predicate) and rows.scannable(predicate):
+            matched = rows.matches(predicate)
+        elif key is None and self.search_index is not None:
+            matched = self.search_index.matches(utility.as_predicate(predicate))
+        else:
+            predicate = utility.as_predicate(predicate)
+            rows, row_key = self._source_keyed(key)
+            candidates = self._filter.indices if self._filter is not None \
+                else xrange(len(rows))
+            return [index for index in candidates if predicate(row_key(index))]
+        if self._filter is not None:
+            shown = frozenset(self._filter.indices)
+            matched = [index for index in matched if index in shown]
+        return matched
+
+    def selected(self):
+        # Positions in the body of the selected rows, in order
+        return iter(self.selection)
+
+    def inc_search(self, predicate, direction, key=None):
         start = self.search_anchor if self.search_anchor is not None else self.focus_position
         self.search_anchor = start
 
-        # Selects the item from the enumerable
-        wrapped_key = lambda x: key( x[1] )
-        iterable = shift_iterable(
-            tuple(enumerate(self.body[:])), 
-            start, direction
-        )
-
-        rtrn = search(
-            iterable,
-            predicate,
-            key=wrapped_key
-        )
-        if rtrn is None:
+        store = self._text_rows(predicate, key)
+        if store is not None:
+            index = store.find(predicate, start, direction)
+        else:
+            rows, row_key = self._keyed(key)
+            index = search(
+                shift_range(len(rows), start, direction),
+                utility.as_predicate(predicate),
+                key=row_key
+            )
+        if index is None:
             self.set_focus(start)
         else:
-            index, item = rtrn
             self.set_focus(index)
-    
-    def _search(self, iterable):
-        return self._searcher(
-            iterable,
+
+    def _search(self, start, direction):
+        if self._query is None:
+            return None
+        predicate, key = self._query
+        store = self._text_rows(predicate, key)
+        if store is not None:
+            return store.find(predicate, start, direction)
+        predicate = utility.as_predicate(predicate)
+        if key is None and self.search_index is not None and not self.filtered:
+            return self.search_index.find(predicate, start, direction)
+        rows, row_key = self._keyed(key)
+        return search(
+            shift_range(len(rows), start, direction),
+            predicate,
+            key=row_key
         )
 
-        
-    def search(self, predicate, direction, start=None, key=(lambda x: x)):
+    def _text_rows(self, predicate, key):
+        # Searching a RowStore for a string or compiled regular expression
+        # scans its buffer directly, without making an object per row
+        rows = self._rows()
+        if key is None and self.search_index is None and not self.filtered \
+                and isinstance(rows, utility.RowStore) \
+                and utility.is_pattern(predicate) and rows.scannable(predicate):
+            return rows
+        return None
+
+    def search(self, predicate, direction, start=None, key=None):
 
         self.search_anchor = None
         search_start = self.focus_position if start is None else start
 
-        wrapped_key = lambda x: key( x[1] )
+        if self._text_rows(predicate, key) is None:
+            # Made once, so a search index can keep its matches for it
+            predicate = utility.as_predicate(predicate)
+        self._query = (predicate, key)
+        self._direction = direction
 
-        iterable = shift_iterable(
-            tuple(enumerate(self.body[:])), 
-            search_start,
-            direction,
-        )
-
-        # start = self.focus_position if start is 
-        self._searcher = partial(
-            search,
-            predicate=predicate,
-            key=wrapped_key
-        )
-
-        self._builder = partial(
-            shift_iterable,
-            direction=direction
-        )
-
-        rtrn = self._search(iterable)
-
-        if rtrn is None:
-            return None
-        else:
-            # Return the index of the enumerate
-            return rtrn[0]
+        return self._search(search_start, direction)
 
+    def _step(self, direction):
+        if direction == 'forward':
+            return self.focus_position + 1
+        return self.focus_position - 1
 
     def next(self):
-        current_position = self.focus_position + 1
-
-        iterable = self._builder(
-            tuple(enumerate(self.body[:])),
-            current_position
-        )
+        direction = self._direction
+        index = self._search(self._step(direction), direction)
 
-        rtrn = self._search(
-            iterable
-        )
+        if index is not None:
+            self.set_focus(index)
 
-        if rtrn is not None:
-            self.set_focus(rtrn[0])
-    
     def prev(self):
-        current_position = len(self.body[:]) - self.focus_position 
+        direction = 'backward' if self._direction == 'forward' else 'forward'
+        index = self._search(self._step(direction), direction)
 
-        iterable = self._builder(
-            tuple(reversed(tuple(enumerate(self.body[:])))),
-            current_position, 
-        )
+        if index is not None:
+            self.set_focus(index)
 
-        rtrn = self._search(
-            iterable
-        )
+    def isEmpty(self):
+        return len(self.body) == 0
+
+
+class IncrementalSearch(object):
+    def __init__(self, listbox, loop=None, match=(lambda query, row: query in row),
+                 direction='forward', key=None, chunk_size=2000, interval=0.001):
+        # Scans listbox in chunks of chunk_size rows scheduled on the main
+        # loop; the small interval lets the loop redraw between chunks.
+        # Without a loop every update scans synchronously.
+        self.listbox = listbox
+        self.loop = loop
+        self.match = match
+        self.direction = direction
+        self.key = key
+        self.chunk_size = chunk_size
+        self.interval = interval
+
+        self.query = None
+        self.anchor = None
+        self.matches = []
+        self._pending = iter(())
+        self._alarm = None
 
-        if rtrn is not None:
-            self.set_focus(rtrn[0])
+    @property
+    def done(self):
+        return self._alarm is None
 
-    def isEmpty(self):
-        return len(self.body[:]) == 0
+    def update(self, query):
+        self.cancel()
+        if self.anchor is None:
+            self.anchor = self.listbox.focus_position
+
+        if self.query is not None and query.startswith(self.query):
+            # Only rows that still matched the shorter query can match
+            candidates = itertools.chain(self.matches, self._pending)
+        else:
+            candidates = shift_range(
+                len(self.listbox.body), self.anchor, self.direction
+            )
+
+        self.query = query
+        self.matches = []
+        self._pending = candidates
+        self._rows, self._row_key = self.listbox._keyed(self.key)
+
+        if self.loop is None:
+            while self._scan():
+                pass
+        else:
+            self._schedule()
+
+    def cancel(self):
+        if self._alarm is not None:
+            self.loop.remove_alarm(self._alarm)
+            self._alarm = None
+
+    def reset(self):
+        self.cancel()
+        self.query = None
+        self.anchor = None
+        self.matches = []
+        self._pending = iter(())
+
+    def _schedule(self):
+        self._alarm = self.loop.set_alarm_in(self.interval, self._step)
+
+    def _step(self, loop, user_data):
+        self._alarm = None
+        if self._scan():
+            self._schedule()
+
+    def _scan(self):
+        query = self.query
+        match = self.match
+        row_key = self._row_key
+        found = self.matches
+        first = not found
+
+        scanned = 0
+        for index in itertools.islice(self._pending, self.chunk_size):
+            scanned += 1
+            if match(query, row_key(index)):
+                found.append(index)
+
+        if first and found:
+            self.listbox.set_focus(found[0])
+
+        if scanned < self.chunk_size:
+            if not found:
+                self.listbox.set_focus(self.anchor)
+            return False
+        return True
+
+
+class RowStream(object):
+    END = object()
+
+    def __init__(self, listbox, source, loop, batch_size=5000, interval=1 / 30.0,
+                 max_pending=None):
+        # Feeds listbox.extend from source once per interval, at most
+        # batch_size rows at a time. source is a Queue (put END on it to
+        # finish), a file descriptor, which is split into lines as data
+        # arrives, or any other iterable, which is read on a thread since
+        # it may block. At most about max_pending rows are read ahead of
+        # the list: past that the thread waits and the descriptor isn't
+        # read, so a fast producer is held back rather than buffered.
+        self.listbox = listbox
+        self.loop = loop
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending if max_pending is not None \
+            else batch_size * 4
+
+        self.finished = False
+        self._pending = collections.deque()
+        self._exhausted = False
+        self._stopped = False
+        self._queue = None
+        self._fd = None
+        self._watching = False
+        self._partial = ''
+        self._alarm = None
+
+        if isinstance(source, Queue.Queue):
+            self._queue = source
+        elif isinstance(source, (int, long)):
+            self._fd = source
+            self._watch()
+        else:
+            self._queue = Queue.Queue(maxsize=self.max_pending)
+            reader = threading.Thread(target=self._drain, args=(iter(source),))
+            reader.daemon = True
+            reader.start()
+        self._schedule()
+
+    def _drain(self, rows):
+        for row in rows:
+            if not self._put(row):
+                return
+        self._put(RowStream.END)
+
+    def _put(self, row):
+        # Waits for room, giving up once stopped
+        while not self._stopped:
+            try:
+                self._queue.put(row, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _read(self):
+        data = os.read(self._fd, 65536)
+        if not data:
+            if self._partial:
+                self._pending.append(self._partial)
+                self._partial = ''
+            self._unwatch()
+            self._exhausted = True
+            return
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        self._pending.extend(lines)
+        if len(self._pending) >= self.max_pending:
+            # Read again once the list has caught up
+            self._pause()
+
+    def _watch(self):
+        if self._fd is not None and not self._watching:
+            self.loop.watch_file(self._fd, self._read)
+            self._watching = True
+
+    def _pause(self):
+        if self._watching:
+            self.loop.remove_watch_file(self._fd)
+            self._watching = False
+
+    def _unwatch(self):
+        self._pause()
+        self._fd = None
+
+    def _schedule(self):
+        self._alarm = self.loop.set_alarm_in(self.interval, self._flush)
+
+    def _take(self):
+        pending = self._pending
+        rows = [pending.popleft() for _ in xrange(min(len(pending), self.batch_size))]
+        if self._queue is not None:
+            while len(rows) < self.batch_size:
+                try:
+                    row = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if row is RowStream.END:
+                    self._exhausted = True
+                    break
+                rows.append(row)
+        return rows
+
+    def _flush(self, loop=None, user_data=None):
+        self._alarm = None
+        self.listbox.extend(self._take())
+        if self._exhausted and not self._pending:
+            self.finished = True
+        elif not self._stopped:
+            if len(self._pending) < self.max_pending:
+                self._watch()
+            self._schedule()
+
+    def stop(self):
+        self._stopped = True
+        if self._alarm is not None:
+            self.loop.remove_alarm(self._alarm)
+            self._alarm = None
+        self._unwatch()
 
 
 class MappedPile(urwid.Pile):
+    selected_attr = 'selected'
+    selected_focus_attr = None
+
     def __init__(self, widgets=[], focus_item=None,
-                 constraint=(lambda x, y: y.selectable()), keymap={}):
-        self.keymap = dict(keymap)
-        self.constraint = constraint
+                 constraint=(lambda x, y: y.selectable()), keymap={},
+                 coalesce=False, loop=None):
+        self.keymap = utility.own_keymap(keymap)
+        self._constraint = constraint
+        self._positions = None
+        # Coalesced as in MappedList
+        self.coalesce = coalesce
+        self.loop = loop
+        self._shift_pending = False
+        self.selection = utility.Selection()
+        # {position: (widget, attributes, wrapper)} for selected items
+        self._styled = {}
+        # What selectable() last answered; None until somebody asks
+        self._selectable = None
         super(MappedPile, self).__init__(widgets, focus_item)
+        self.contents.set_modified_callback(self._contents_changed)
 
     def keypress(self, size, key):
         key = super(MappedPile, self).keypress(size, key)
-        if key in self.keymap:
-            key = self.keymap[key]()
+        handled, key = keymaps.dispatch(self, self.keymap, key)
         return key
 
+    def render(self, size, focus=False):
+        if not self.selection.any():
+            return super(MappedPile, self).render(size, focus)
+
+        # Pile renders the selected items through their styling wrappers,
+        # swapped in for the duration without touching the real contents
+        contents = self._contents
+        self._contents = urwid.MonitoredFocusList(
+            self._styled_contents(), focus=contents.focus
+        )
+        try:
+            return super(MappedPile, self).render(size, focus)
+        finally:
+            self._contents = contents
+
+    def _styled_contents(self):
+        # A wrapper is kept per selected position while it wraps the same
+        # widget in the same attributes, so its canvas stays cached
+        styled = {}
+        contents = list(self.contents)
+        attrs = (self.selected_attr, self.selected_focus_attr)
+        for position in self.selection:
+            widget, options = contents[position]
+            kept = self._styled.get(position)
+            if kept is not None and kept[0] is widget and kept[1] == attrs:
+                wrapper = kept[2]
+            else:
+                wrapper = urwid.AttrMap(widget, *attrs)
+            styled[position] = (widget, attrs, wrapper)
+            contents[position] = (wrapper, options)
+        self._styled = styled
+        return contents
+
+    def _shifted(self):
+        if not self.coalesce:
+            urwid.emit_signal(self, 'shift')
+        elif not self._shift_pending:
+            self._shift_pending = True
+            if self.loop is not None:
+                self.loop.set_alarm_in(0, lambda loop, data: self.flush())
+
+    def flush(self):
+        if self._shift_pending:
+            self._shift_pending = False
+            urwid.emit_signal(self, 'shift')
+
+    @property
+    def constraint(self):
+        return self._constraint
+
+    @constraint.setter
+    def constraint(self, value):
+        self._constraint = value
+        self.refresh()
+
+    def _contents_modified(self, slc, new_items):
+        super(MappedPile, self)._contents_modified(slc, new_items)
+        start, stop, step = slc
+        self.selection.replace(start, stop, len(new_items), step)
+        # A child pile can start or stop taking focus without being
+        # replaced, so the index is rebuilt when it says it has
+        for widget, options in self.contents[start:stop:step]:
+            if isinstance(widget, MappedPile):
+                urwid.disconnect_signal(widget, 'selectable', self._child_toggled)
+        for widget, options in new_items:
+            if isinstance(widget, MappedPile):
+                urwid.connect_signal(widget, 'selectable', self._child_toggled)
+        if self._positions is not None and start == stop == len(self.contents):
+            # Appending can't change the position of anything already
+            # indexed, so only the new rows need checking
+            self._positions.extend(
+                start + offset for offset, (widget, options) in enumerate(new_items)
+                if self.constraint(start + offset, widget)
+            )
+        else:
+            self._positions = None
+
+    def _contents_changed(self):
+        self._invalidate()
+        self._check_selectable()
+
+    def refresh(self):
+        # Call when the constraint would now answer differently for
+        # contents that haven't themselves been replaced; child piles
+        # are followed without it
+        self._positions = None
+        self._check_selectable()
+
+    def _child_toggled(self, child):
+        self.refresh()
+
+    def _check_selectable(self):
+        # Emits 'selectable' when the answer to selectable() changes,
+        # once it has been asked for
+        answered = self._selectable
+        if answered is not None and self.selectable() != answered:
+            urwid.emit_signal(self, 'selectable', self)
+
+    def selectable_positions(self):
+        if self._positions is None:
+            self._positions = [
+                index for index, (widget, options) in enumerate(self.contents)
+                if self.constraint(index, widget)
+            ]
+        return self._positions
+
+    def toggle_selection(self, position=None):
+        position = self.focus_position if position is None else position
+        self.selection.toggle(position)
+        self._invalidate()
+
+    def select_all(self):
+        # Only the items the constraint allows focus on
+        self.selection.update(self.selectable_positions())
+        self._invalidate()
+
+    def select_none(self):
+        self.selection.clear()
+        self._invalidate()
+
+    def invert_selection(self):
+        self.selection.toggle_all(self.selectable_positions())
+        self._invalidate()
+
+    def select_matches(self, predicate, key=(lambda x: x)):
+        predicate = utility.as_predicate(predicate)
+        matched = [
+            position for position in self.selectable_positions()
+            if predicate(key(self.contents[position][0]))
+        ]
+        self.selection.update(matched)
+        self._invalidate()
+        return len(matched)
+
+    def selected(self):
+        return iter(self.selection)
+
     def top(self):
-        for index in xrange(len(self.contents)):
-            widget = self.contents[index][0]
-            if self.constraint(index, widget):
-                self.focus_position = index
-                urwid.emit_signal(self, 'shift')
-                return
+        positions = self.selectable_positions()
+        if positions:
+            self.focus_position = positions[0]
+            self._shifted()
     
     def bottom(self):
-        for index in xrange(len(self.contents) - 1, -1, -1):
-            widget = self.contents[index][0]
-            if self.constraint(index, widget):
-                self.focus_position = index
-                urwid.emit_signal(self, 'shift')
-                return
+        positions = self.selectable_positions()
+        if positions:
+            self.focus_position = positions[-1]
+            self._shifted()
+
+    def _move(self, index):
+        self.focus_position = self.selectable_positions()[index]
+        self._shifted()
 
     def shiftDown(self, amount=1):
-        try:
-            nextIndex = (
-                index for index, widget in
-                enumerate([cont[0] for cont in self.contents])
-                if index > self.focus_position
-                and self.constraint(index, widget)
-            ).next()
-            self.focus_position = nextIndex
-            urwid.emit_signal(self, 'shift')
-        except StopIteration:
+        positions = self.selectable_positions()
+        index = bisect.bisect_right(positions, self.focus_position)
+        if index < len(positions):
+            self._move(min(index + amount - 1, len(positions) - 1))
+        else:
             urwid.emit_signal(self, 'bottom')
 
     def shiftUp(self, amount=1):
-        try:
-            nextIndex = (
-                index for index, widget in
-                utility.renumerate([cont[0] for cont in self.contents]) 
-                if index < self.focus_position
-                and self.constraint(index, widget)
-            ).next()
-            self.focus_position = nextIndex
-            urwid.emit_signal(self, 'shift')
-        except StopIteration:
+        positions = self.selectable_positions()
+        index = bisect.bisect_left(positions, self.focus_position) - 1
+        if index >= 0:
+            self._move(max(index - amount + 1, 0))
+        else:
             urwid.emit_signal(self, 'top')
 
     def selectable(self):
-        return reduce(
-            (lambda x, y: x | y),
-            [self.constraint(index, widget[0]) for index, widget in enumerate(self.contents)]
-        )
+        self._selectable = bool(self.selectable_positions())
+        return self._selectable
 
     def isEmpty(self):
         return len(self.contents) == 0
@@ -499,38 +1907,177 @@ class MappedPile(urwid.Pile):
     def set(self, widgets):
         self.contents = [(widget, self.options()) for widget in widgets]
 
+    def update(self, widgets, key=(lambda x: x), start=0):
+        # Like set, but only inserts and removes what difflib finds has
+        # changed, comparing key(widget); widgets with an unchanged key
+        # are kept, and focus stays on the one with the same key.
+        # Contents before start are left alone.
+        widgets = list(widgets)
+        old = [widget for widget, options in self.contents[start:]]
+        old_keys, new_keys, opcodes = keyed_diff(old, widgets, key)
+        moved = moved_items(opcodes, old_keys, new_keys)
+        kept = kept_positions(opcodes, moved)
+        marks = [
+            index if index < start else start + kept[index - start]
+            for index in self.selection
+            if index < start or index - start in kept
+        ]
+        focus = None
+        if len(self.contents) > start and self.focus_position >= start:
+            focus = updated_position(
+                opcodes, moved, self.focus_position - start, len(widgets)
+            )
+
+        for tag, i1, i2, j1, j2 in reversed(opcodes):
+            if tag != 'equal':
+                self.contents[start + i1:start + i2] = [
+                    (old[moved[index]] if index in moved else widgets[index],
+                     self.options())
+                    for index in xrange(j1, j2)
+                ]
+        self.selection.reset(len(self.contents))
+        self.selection.update(marks)
+        if focus is not None and widgets:
+            self.focus_position = start + focus
+
 
 class TitledPile(MappedPile):
     def __init__(self, title=urwid.Text(''), widgets=[], *args, **kwargs):
+        # Collapsed, only the title is in contents, so the rest is neither
+        # rendered nor checked against the constraint. With a factory, the
+        # widgets are only asked for when the pile is first expanded.
+        self._factory = kwargs.pop('factory', None)
+        self._collapsed = kwargs.pop('collapsed', False)
+        self._hidden = None
+        self._hidden_marks = []
         self.title = title
+        if self._factory is not None and not self._collapsed:
+            widgets = self._build()
+        if self._collapsed:
+            if self._factory is None:
+                self._hidden = [(widget, self.options()) for widget in widgets]
+            widgets = []
         widgets = [title] + widgets
         super(TitledPile, self).__init__(widgets, *args, **kwargs)
-        if not self.isEmpty():
+        if len(self.contents) >= 2:
             self.focus_position = 1
 
-    def shiftUp(self):
+    def _build(self):
+        widgets = list(self._factory())
+        self._factory = None
+        return widgets
+
+    def _hidden_contents(self):
+        if self._hidden is None:
+            self._hidden = [(widget, self.options()) for widget in self._build()]
+        return self._hidden
+
+    def keypress(self, size, key):
+        if not self._collapsed:
+            return super(TitledPile, self).keypress(size, key)
+        # The title takes no keys
+        handled, key = keymaps.dispatch(self, self.keymap, key)
+        return key
+
+    def selectable(self):
+        # Collapsed, it can still be focused so that it can be expanded
+        self._selectable = self._collapsed or bool(self.selectable_positions())
+        return self._selectable
+
+    @property
+    def collapsed(self):
+        return self._collapsed
+
+    def collapse(self):
+        if self._collapsed:
+            return
+        self._hidden = self.contents[1:]
+        self._hidden_marks = [index - 1 for index in self.selection if index]
+        self._collapsed = True
+        del self.contents[1:]
+        self.focus_position = 0
+        self._check_selectable()
+        urwid.emit_signal(self, 'collapse', self)
+
+    def expand(self):
+        if not self._collapsed:
+            return
+        hidden = self._hidden_contents()
+        self._hidden = None
+        self._collapsed = False
+        self.contents.extend(hidden)
+        self.selection.update(index + 1 for index in self._hidden_marks)
+        self._hidden_marks = []
+        if len(self.contents) >= 2:
+            self.focus_position = 1
+        self._check_selectable()
+        urwid.emit_signal(self, 'expand', self)
+
+    def toggle(self):
+        if self._collapsed:
+            self.expand()
+        else:
+            self.collapse()
+
+    def shiftUp(self, amount=1):
         if self.focus_position > 1:
-            super(TitledPile, self).shiftUp()
+            super(TitledPile, self).shiftUp(amount)
         else:
             urwid.emit_signal(self, 'top')
 
     def isEmpty(self):
+        if self._collapsed:
+            # Not yet built counts as not empty
+            return self._hidden is not None and not self._hidden
         return len(self.contents) == 1
 
     def add(self, widget):
+        if self._collapsed:
+            self._hidden_contents().append((widget, self.options()))
+            return
         self.contents.append((widget, self.options()))
         if len(self.contents) == 2:
             self.focus_position = 1
 
     def set(self, widgets):
+        if self._collapsed:
+            self._factory = None
+            self._hidden = [(widget, self.options()) for widget in widgets]
+            self._hidden_marks = []
+            return
         super(TitledPile, self).set((self.title,) + tuple(widgets))
         if len(self.contents) >= 2:
             self.focus_position = 1
 
+    def update(self, widgets, key=(lambda x: x)):
+        if self._collapsed:
+            self._update_hidden(list(widgets), key)
+            return
+        super(TitledPile, self).update(widgets, key, start=1)
+        if len(self.contents) >= 2 and self.focus_position == 0:
+            self.focus_position = 1
+
+    def _update_hidden(self, widgets, key):
+        # As update does, on the contents put away while collapsed
+        if self._hidden is None:
+            self.set(widgets)
+            return
+        old = [widget for widget, options in self._hidden]
+        old_keys, new_keys, opcodes = keyed_diff(old, widgets, key)
+        kept = kept_positions(opcodes, moved_items(opcodes, old_keys, new_keys))
+        hidden = [(widget, self.options()) for widget in widgets]
+        for index, new in kept.items():
+            hidden[new] = self._hidden[index]
+        self._hidden = hidden
+        self._hidden_marks = sorted(
+            kept[index] for index in self._hidden_marks if index in kept
+        )
+
     def setTitle(self, widget):
         self.title = widget
         self.contents[0] = (widget, self.options())
 
-urwid.register_signal(TitledPile, ('shift', 'bottom', 'top'))
-urwid.register_signal(MappedPile, ('shift', 'bottom', 'top'))
+urwid.register_signal(TitledPile, ('shift', 'bottom', 'top', 'selectable',
+                                   'collapse', 'expand'))
+urwid.register_signal(MappedPile, ('shift', 'bottom', 'top', 'selectable'))
 urwid.register_signal(MappedList, ('shift', 'bottom', 'top'))
@@ -1,6 +1,20 @@
+import heapq
+import inspect
 import itertools
+import mmap
+import os
+import re
+import string
+import threading
+import time
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
+from keymaps import Keymap
 
 def complete(iterable, start_string):
+    if isinstance(iterable, (CompletionIndex, FuzzyIndex)):
+        return iterable.complete(start_string)
     hits = [
         item[len(start_string):]
         for item in iterable
@@ -18,6 +32,32 @@ def complete(iterable, start_string):
         ])
         return (most_common_string, tuple(sorted(map(lambda x: start_string + x, hits))))
 
+def check_arguments(func, count):
+    try:
+        spec = inspect.getargspec(func)
+    except TypeError:
+        # Not introspectable (builtins, partials, mocks); let the call fail
+        return
+    args = spec.args[1:] if inspect.ismethod(func) else spec.args
+    required = len(args) - len(spec.defaults or ())
+    if count < required or (spec.varargs is None and count > len(args)):
+        raise TypeError("%s takes %d arguments (%d given)" % (
+            func.__name__, len(args), count
+        ))
+
+class FrozenKeymap(dict):
+    # Can't be changed, so widgets share it instead of copying it
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenKeymap can't be modified")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+def own_keymap(keymap):
+    if isinstance(keymap, (FrozenKeymap, Keymap)):
+        return keymap
+    return dict(keymap)
+
 def renumerate(iterable):
     return (
         (index, iterable[index])
@@ -25,27 +65,607 @@ def renumerate(iterable):
         xrange(len(iterable) - 1, -1, -1)
     )
 
-def cached_coroutine(func):
-    cache = {}
-    def inner(*args, **kwargs):
-        wrapped = func(*args, **kwargs)
-        cache[wrapped] = wrapped.next()
-
-        def interface(*args):
-            if len(args) != 0:
-                cache[wrapped] = wrapped.send(*args)
-            return cache[wrapped]
-        return interface
-    return inner
-    
-@cached_coroutine
-def scroll(collection, initial=0):
-    max_length = len(collection) - 1
-    index = initial
-    while True:
-        recieved = (yield collection[index])
-        index += recieved
+class Selection(object):
+    # One byte per row, so that selecting, inverting and counting every
+    # row are bytearray operations rather than a python loop
+    _invert = string.maketrans('\x00\x01', '\x01\x00')
+
+    def __init__(self, length=0):
+        self._marks = bytearray(length)
+
+    def __len__(self):
+        return len(self._marks)
+
+    def __contains__(self, index):
+        return 0 <= index < len(self._marks) and self._marks[index] == 1
+
+    def __iter__(self):
+        # Selected indices in order
+        marks = self._marks
+        index = marks.find('\x01')
+        while index != -1:
+            yield index
+            index = marks.find('\x01', index + 1)
+
+    def any(self):
+        return '\x01' in self._marks
+
+    def count(self):
+        return self._marks.count('\x01')
+
+    def add(self, index):
+        self._marks[index] = 1
+
+    def discard(self, index):
+        self._marks[index] = 0
+
+    def toggle(self, index):
+        self._marks[index] ^= 1
+
+    def update(self, indices):
+        marks = self._marks
+        for index in indices:
+            marks[index] = 1
+
+    def toggle_all(self, indices):
+        marks = self._marks
+        for index in indices:
+            marks[index] ^= 1
+
+    def select_all(self):
+        self._marks = bytearray('\x01') * len(self._marks)
+
+    def clear(self):
+        self._marks = bytearray(len(self._marks))
+
+    def invert(self):
+        self._marks = self._marks.translate(self._invert)
+
+    def replace(self, start, stop, count, step=1):
+        # Follows the rows through a slice assignment, with the new rows
+        # unselected
+        if step != 1:
+            if count:
+                self._marks[start:stop:step] = bytearray(count)
+            else:
+                del self._marks[start:stop:step]
+            return
+        self._marks[start:max(start, stop)] = bytearray(count)
+
+    def reset(self, length):
+        self._marks = bytearray(length)
+
+    def permute(self, order):
+        # Position n now holds the row that was at order[n]
+        self._marks = bytearray(map(self._marks.__getitem__, order))
+
+
+class Cursor(object):
+    # Clamped position within [0, length - 1], moved by calling with an
+    # offset and read by calling with none
+    __slots__ = ('length', 'position')
+
+    def __init__(self, length, position=0):
+        self.reset(length, position)
+
+    def reset(self, length, position=0):
+        self.length = length
+        self.position = 0
+        self(position)
+
+    def __call__(self, amount=0):
+        if amount:
+            position = self.position + amount
+            if position < 0:
+                position = 0
+            elif position > self.length - 1:
+                position = max(self.length - 1, 0)
+            self.position = position
+        return self.position
+
+
+class RingBuffer(object):
+    # A sequence of at most max_rows items; extending it past that drops
+    # the oldest. evicted counts every item dropped so far, so
+    # evicted + index identifies an item for as long as it is kept.
+    def __init__(self, iterable=(), max_rows=None):
+        self.max_rows = max_rows
+        self.evicted = 0
+        self._items = []
+        self._start = 0
+        self.extend(iterable)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        size = len(self._items)
+        if index < 0:
+            index += size
+        if index < 0 or index >= size:
+            raise IndexError(index)
+        return self._items[(self._start + index) % size]
+
+    def __iter__(self):
+        return itertools.chain(
+            itertools.islice(self._items, self._start, None),
+            itertools.islice(self._items, 0, self._start)
+        )
+
+    def extend(self, rows):
+        # Returns how many items were dropped to make room
+        items = self._items
+        if self.max_rows is None:
+            items.extend(rows)
+            return 0
+
+        rows = list(rows)
+        capacity = self.max_rows
+        if len(rows) >= capacity:
+            dropped = len(items) + len(rows) - capacity
+            self._items = rows[len(rows) - capacity:]
+            self._start = 0
+        else:
+            room = capacity - len(items)
+            items.extend(rows[:room])
+            rest = rows[room:]
+            dropped = len(rest)
+            # Overwrite the oldest in place, wrapping round the end
+            first = min(dropped, capacity - self._start)
+            items[self._start:self._start + first] = rest[:first]
+            items[:dropped - first] = rest[first:]
+            self._start = (self._start + dropped) % capacity
+        self.evicted += dropped
+        return dropped
+
+
+PATTERN_TYPE = type(re.compile(''))
+
+def is_pattern(predicate):
+    return isinstance(predicate, (basestring, PATTERN_TYPE))
+
+def as_predicate(predicate):
+    # Strings and compiled regular expressions search the row's text
+    if isinstance(predicate, basestring):
+        return lambda row: predicate in row
+    if isinstance(predicate, PATTERN_TYPE):
+        return lambda row: predicate.search(row) is not None
+    return predicate
+
+
+class RowStore(object):
+    # Text rows kept in one buffer, a string or a memory mapped file, and
+    # found by the offsets of their starts; a row only becomes a string
+    # when it is asked for
+    def __init__(self, buffer, encoding=None):
+        self.buffer = buffer
+        self.encoding = encoding
+        self.offsets = self._scan(buffer)
+
+    @classmethod
+    def from_rows(cls, rows, encoding=None):
+        if encoding:
+            rows = (row.encode(encoding) for row in rows)
+        return cls(''.join(row + '\n' for row in rows), encoding)
+
+    @classmethod
+    def from_file(cls, path, encoding=None):
+        with open(path, 'rb') as source:
+            if os.fstat(source.fileno()).st_size == 0:
+                return cls('', encoding)
+            return cls(mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ), encoding)
+
+    @staticmethod
+    def _scan(buffer):
+        # One pass over the buffer. offsets[n] is where row n starts and
+        # the last entry is one past the end of the last row's newline,
+        # real or not
+        offsets = array('l', [0])
+        size = len(buffer)
+        if not size:
+            return offsets
+        find = buffer.find
+        position = find('\n')
+        while position != -1:
+            offsets.append(position + 1)
+            position = find('\n', position + 1)
+        if offsets[-1] != size:
+            offsets.append(size + 1)
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        count = len(self.offsets) - 1
         if index < 0:
-            index = 0
-        elif index > max_length:
-            index = max_length
+            index += count
+        if index < 0 or index >= count:
+            raise IndexError(index)
+        row = self.buffer[self.offsets[index]:self.offsets[index + 1] - 1]
+        return row.decode(self.encoding) if self.encoding else row
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def scannable(self, pattern):
+        # Whether find and matches can run pattern over the buffer itself
+        return self._compiled(pattern) is not None
+
+    def _compiled(self, pattern):
+        # The pattern in the buffer's bytes, or None if it can't be
+        # matched there: unicode that won't encode, a newline, or a
+        # regular expression with characters that encode to several
+        # bytes, which classes and repeats would take apart
+        text = pattern if isinstance(pattern, basestring) else pattern.pattern
+        if isinstance(text, unicode):
+            try:
+                text = text.encode(self.encoding or 'ascii')
+            except UnicodeError:
+                return None
+            if not isinstance(pattern, basestring) \
+                    and any(ord(char) > 127 for char in text):
+                return None
+        if isinstance(pattern, basestring):
+            return text if '\n' not in text else None
+        if text is not pattern.pattern or not pattern.flags & re.M:
+            # re.M so that ^ and $ match at the start and end of every row
+            pattern = re.compile(text, pattern.flags | re.M)
+        return pattern
+
+    def matches(self, pattern):
+        # Every row with a match, in order
+        pattern = self._compiled(pattern)
+        if not len(self) or pattern is None:
+            return []
+        offsets = self.offsets
+        end = min(offsets[-1], len(self.buffer))
+        rows = []
+        position = self._first(pattern, 0, end)
+        while position is not None:
+            row = bisect_right(offsets, position) - 1
+            rows.append(row)
+            position = self._first(pattern, offsets[row + 1], end)
+        return rows
+
+    def _first(self, pattern, low, high):
+        # Offset of the first match within one row in [low, high)
+        if isinstance(pattern, basestring):
+            position = self.buffer.find(pattern, low, high)
+            return position if position != -1 else None
+        offsets = self.offsets
+        match = pattern.search(self.buffer, low, high)
+        while match is not None:
+            row = bisect_right(offsets, match.start()) - 1
+            if match.end() < offsets[row + 1]:
+                return match.start()
+            match = pattern.search(self.buffer, match.start() + 1, high)
+        return None
+
+    def _last(self, pattern, low, high):
+        if isinstance(pattern, basestring):
+            position = self.buffer.rfind(pattern, low, high)
+            return position if position != -1 else None
+        offsets = self.offsets
+        last = None
+        for match in pattern.finditer(self.buffer, low, high):
+            row = bisect_right(offsets, match.start()) - 1
+            if match.end() < offsets[row + 1]:
+                last = match.start()
+        return last
+
+    def find(self, pattern, start, direction):
+        # First row from start (wrapping around) with a match for pattern,
+        # a string or compiled regular expression, found by scanning the
+        # buffer rather than the rows. Matches may not span rows.
+        count = len(self)
+        pattern = self._compiled(pattern)
+        if not count or pattern is None:
+            return None
+        start %= count
+        offsets = self.offsets
+        end = min(offsets[count], len(self.buffer))
+        if direction == 'forward':
+            spans = ((offsets[start], end), (0, offsets[start]))
+            scan = self._first
+        else:
+            spans = ((0, offsets[start + 1] - 1), (offsets[start + 1], end))
+            scan = self._last
+        for low, high in spans:
+            position = scan(pattern, low, high)
+            if position is not None:
+                return bisect_right(offsets, position) - 1
+        return None
+
+
+class SearchIndex(object):
+    def __init__(self, rows, key=(lambda x: x)):
+        self.key = key
+        self.rebuild(rows)
+
+    def rebuild(self, rows):
+        self.keys = [self.key(row) for row in rows]
+        self._predicate = None
+        self._matches = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def matches(self, predicate):
+        # Match positions are only kept for the most recent predicate
+        if predicate is not self._predicate:
+            self._matches = [
+                index for index, key in enumerate(self.keys)
+                if predicate(key)
+            ]
+            self._predicate = predicate
+        return self._matches
+
+    def replace(self, start, stop, rows, step=1):
+        new_keys = [self.key(row) for row in rows]
+        if step != 1:
+            if new_keys:
+                self.keys[start:stop:step] = new_keys
+            else:
+                del self.keys[start:stop:step]
+            self._predicate = None
+            self._matches = None
+            return
+
+        stop = max(start, stop)
+        self.keys[start:stop] = new_keys
+
+        if self._matches is not None:
+            matches = self._matches
+            predicate = self._predicate
+            delta = len(new_keys) - (stop - start)
+            low = bisect_left(matches, start)
+            high = bisect_left(matches, stop)
+            matches[low:] = [
+                start + index for index, key in enumerate(new_keys)
+                if predicate(key)
+            ] + [
+                index + delta for index in matches[high:]
+            ]
+
+    def permute(self, order):
+        # The rows were reordered, without changing their keys
+        self.keys = map(self.keys.__getitem__, order)
+        self._predicate = None
+        self._matches = None
+
+    def find(self, predicate, start, direction):
+        # Wraps around like a cyclic scan starting at start
+        matches = self.matches(predicate)
+        if not matches:
+            return None
+        if direction == 'forward':
+            index = bisect_left(matches, start)
+            return matches[index] if index < len(matches) else matches[0]
+        else:
+            index = bisect_right(matches, start) - 1
+            return matches[index] if index >= 0 else matches[-1]
+
+
+class CompletionIndex(object):
+    def __init__(self, iterable):
+        # Sorted case-folded, so every completion of a prefix is one
+        # contiguous run found with a bisect
+        entries = sorted((item.lower(), item) for item in iterable)
+        self._folded = [folded for folded, item in entries]
+        self._items = [item for folded, item in entries]
+
+    def __len__(self):
+        return len(self._items)
+
+    def hits(self, start_string):
+        folded = start_string.lower()
+        keys = self._folded
+        low = bisect_left(keys, folded)
+        high = low
+        while high < len(keys) and keys[high].startswith(folded):
+            high += 1
+        return self._items[low:high]
+
+    def complete(self, start_string):
+        # Same contract as complete(), with hits in case-insensitive order
+        suffixes = [
+            item[len(start_string):] for item in self.hits(start_string)
+        ]
+        if not suffixes:
+            return (start_string, tuple())
+        return (
+            start_string + os.path.commonprefix(suffixes),
+            tuple(start_string + suffix for suffix in suffixes)
+        )
+
+
+class FuzzyIndex(object):
+    # Candidates are case-folded into one newline separated buffer, so a
+    # query is matched against all of them in a single regular expression
+    # scan rather than a python call per candidate. Only the candidates
+    # that match are scored: fewest characters between the query's
+    # letters first, then matches starting a word, then earlier matches,
+    # then shorter candidates.
+    separators = ' _-./:'
+
+    def __init__(self, iterable, limit=None):
+        self.items = list(iterable)
+        self.limit = limit
+        self._buffer = ''.join(
+            item.lower().replace('\n', ' ') + '\n' for item in self.items
+        )
+        self._starts = array('l', [0])
+        for item in self.items:
+            self._starts.append(self._starts[-1] + len(item) + 1)
+        self._last = (None, None)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _patterns(self, query):
+        # Each gap stops at the first of the next character, so a line is
+        # matched in one pass and a line with many near misses can't make
+        # the engine backtrack through every way of placing the query
+        chars = [re.escape(char) for char in query.lower()]
+        body = chars[0] + ''.join(
+            '[^\n%s]*%s' % (char, char) for char in chars[1:]
+        )
+        return (
+            re.compile('(?m)^[^\n%s]*(%s)' % (chars[0], body)),
+            re.compile('[^\n]*(%s)' % body)
+        )
+
+    def scored(self, query):
+        # (score..., index) for every matching candidate, in index order
+        if query == self._last[0]:
+            return self._last[1]
+        starts = self._starts
+        if not query:
+            found = [
+                (0, False, 0, starts[index + 1] - starts[index], index)
+                for index in xrange(len(self.items))
+            ]
+        else:
+            buffer = self._buffer
+            separators = self.separators
+            first, last = self._patterns(query)
+            # The first match on a line ends as early as any can; matching
+            # again up to there from the right finds where the tightest
+            # match ending there starts
+            shrink = last.match if len(query) > 1 else None
+            found = []
+            for match in first.finditer(buffer):
+                line = match.start()
+                start, end = match.span(1)
+                if shrink is not None:
+                    start = shrink(buffer, start, end).start(1)
+                index = bisect_right(starts, line) - 1
+                found.append((
+                    end - start - len(query),
+                    start != line and buffer[start - 1] not in separators,
+                    start - line,
+                    starts[index + 1] - line,
+                    index
+                ))
+        self._last = (query, found)
+        return found
+
+    def matches(self, query):
+        return [score[-1] for score in self.scored(query)]
+
+    def rank(self, query, limit=None):
+        # Indices of the best matches, best first
+        limit = limit if limit is not None else self.limit
+        found = self.scored(query)
+        if limit is None:
+            ranked = sorted(found)
+        else:
+            ranked = heapq.nsmallest(limit, found)
+        return [score[-1] for score in ranked]
+
+    def hits(self, query, limit=None):
+        return [self.items[index] for index in self.rank(query, limit)]
+
+    def complete(self, start_string):
+        # Same contract as complete(); hits are ranked and there is no
+        # common prefix to extend to, so only a single hit completes
+        hits = tuple(self.hits(start_string))
+        if len(hits) == 1:
+            return (hits[0], hits)
+        return (start_string, hits)
+
+
+class _LoadedCompletions(object):
+    def __init__(self, expires, index_type=CompletionIndex):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.loaded_at = time.time()
+        self.expires = expires
+        self.index_type = index_type
+        self._index = None
+        self._indexed = -1
+
+    def load(self, produce, background):
+        def run():
+            try:
+                for item in produce():
+                    self.items.append(item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.done = True
+
+        if background:
+            worker = threading.Thread(target=run)
+            worker.daemon = True
+            worker.start()
+        else:
+            run()
+
+    def expired(self, ttl):
+        return self.expires and ttl is not None \
+            and time.time() - self.loaded_at > ttl
+
+    def index(self):
+        # Only what has arrived so far; rebuilt when more has come in
+        count = len(self.items)
+        if count != self._indexed:
+            self._index = self.index_type(self.items[:count])
+            self._indexed = count
+        return self._index
+
+
+class CompletionSource(object):
+    def __init__(self, source, ttl=None, max_entries=16, background=True,
+                 index_type=CompletionIndex):
+        # source is an iterable, or a callable that is given the command
+        # arguments preceding the one being completed and returns one.
+        # Results are memoized per argument tuple, oldest evicted first.
+        # index_type may be FuzzyIndex (or a partial of it) for fuzzy
+        # completion.
+        self.source = source
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.background = background
+        self.index_type = index_type
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _produce(self, args):
+        if callable(self.source):
+            return lambda: self.source(*args)
+        return lambda: self.source
+
+    def entry(self, *args):
+        if not callable(self.source):
+            # The same rows whatever the arguments, and a generator can
+            # only be read once
+            args = ()
+        load = False
+        with self._lock:
+            entry = self._entries.pop(args, None)
+            if entry is None or entry.expired(self.ttl):
+                # A plain iterable may be a generator, which can only be
+                # consumed once, so only callables expire
+                entry = _LoadedCompletions(callable(self.source), self.index_type)
+                load = True
+            self._entries[args] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if load:
+            entry.load(self._produce(args), self.background)
+        return entry
+
+    def index(self, *args):
+        return self.entry(*args).index()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()